@@ -6,8 +6,11 @@ import subprocess
 import requests
 import logging
 import random
+import socket
+import time
 import os.path
 import threading
+import itertools
 from js_test_tool.util import retry
 
 LOGGER = logging.getLogger(__name__)
@@ -34,11 +37,36 @@ class SrcInstrumenter(object):
     # that has not yet become available.
     MAX_CONNECT_ATTEMPTS = 10
 
-    # Wait time between attempts
-    WAIT_BETWEEN_ATTEMPTS = 0.4
+    # Wait time between attempts grows exponentially from
+    # `BASE_DELAY` up to `MAX_DELAY` seconds.  Each wait is randomly
+    # stretched by up to `JITTER` so that instrumenters started
+    # together do not retry at the same time.
+    BASE_DELAY = 0.05
+    MAX_DELAY = 2.0
+    JITTER = 0.5
 
-    # Keep track of used ports across classes
-    used_ports = []
+    # Amount of time to wait for JSCover to start listening
+    # on its port, and the time between checks.
+    STARTUP_TIMEOUT = 5.0
+    STARTUP_POLL_SEC = 0.05
+
+    # Number of bytes to read at a time when streaming sources
+    STREAM_CHUNK_SIZE = 65536
+
+    # Maximum time (in seconds) to wait for JSCover to connect
+    # or to send data, so a hung JSCover can't block a request forever.
+    REQUEST_TIMEOUT = 10.0
+
+    # Maximum number of connections to keep open to the JSCover service
+    MAX_POOL_CONNECTIONS = 16
+
+    # Number of random ports to check before giving up
+    # on finding an unused one.
+    MAX_PORT_ATTEMPTS = 100
+
+    # Keep track of used ports across instances
+    used_ports = set()
+    _used_ports_lock = threading.Lock()
 
     def __init__(self, root_dir, tool_path=None,
                  subprocess_module=subprocess, requests_module=requests):
@@ -59,10 +87,39 @@ class SrcInstrumenter(object):
         self._subprocess = subprocess_module
         self._requests = requests_module
 
+        # Use a single session for every request to JSCover, so
+        # that we re-use the same keep-alive connection instead of
+        # opening a new socket for each source file.
+        # The page server handles requests concurrently, so allow
+        # several connections to the local JSCover server in the pool.
+        self._session = requests_module.Session()
+        self._session.mount(
+            'http://127.0.0.1',
+            requests_module.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=self.MAX_POOL_CONNECTIONS
+            )
+        )
+
         # Create a variables to store JSCover information
         self._port_num = None
         self._jscover = None
 
+        # Cache instrumented sources, mapping relative paths
+        # to the instrumented source (unicode)
+        self._src_cache = {}
+
+        # Map relative paths to `threading.Event`s for sources
+        # we are currently retrieving from JSCover, so concurrent
+        # requests for the same source share one JSCover request.
+        self._pending_dict = {}
+        self._pending_lock = threading.Lock()
+
+        # Lock held while starting or stopping JSCover, so concurrent
+        # retries cannot start it twice, and `stop()` cannot race a restart.
+        # Once stopped, we do not restart JSCover to recover from errors.
+        self._state_lock = threading.Lock()
+        self._is_stopped = False
+
     def start(self):
         """
         Start the service.  The caller is responsible for calling `stop()`.
@@ -72,6 +129,27 @@ class SrcInstrumenter(object):
         error.  If it cannot find an open local port after a certain
         number of trieds, it raises a `SrcInstrumenterError`.
         """
+        with self._state_lock:
+            self._is_stopped = False
+            self._start_if_needed()
+
+    def _restart(self):
+        """
+        Start the service again (if it is not running) to recover
+        from an error retrieving a source, unless `stop()` was called.
+
+        Raises a `SrcInstrumenterError` if the service was stopped.
+        """
+        with self._state_lock:
+            if self._is_stopped:
+                raise SrcInstrumenterError("JSCover was stopped.")
+            self._start_if_needed()
+
+    def _start_if_needed(self):
+        """
+        Start the service if it is not already running.
+        The caller must hold `_state_lock`.
+        """
 
         if self._jscover is None:
 
@@ -79,8 +157,11 @@ class SrcInstrumenter(object):
                 self._port_num, self._jscover = retry(
                     self._start_jscover,
                     self.MAX_START_ATTEMPTS,
-                    self.WAIT_BETWEEN_ATTEMPTS,
+                    self.BASE_DELAY,
                     fail_fast_errors=[OSError],
+                    backoff=2,
+                    max_wait_sec=self.MAX_DELAY,
+                    jitter=self.JITTER,
                     name="Start JSCover"
                 )
             except OSError:
@@ -96,20 +177,35 @@ class SrcInstrumenter(object):
         Stop the service.
         """
 
-        # Terminate the JSCover service
-        if self._jscover is not None:
-            try:
-                self._jscover.terminate()
+        with self._state_lock:
 
-            except OSError:
-                LOGGER.debug("Could not terminate JSCover instance.")
+            # Don't restart the service to recover from errors
+            # in requests that are still running.
+            self._is_stopped = True
 
-            finally:
-                self._jscover = None
+            # Terminate the JSCover service
+            if self._jscover is not None:
+                try:
+                    self._jscover.terminate()
 
-        else:
-            msg = "stop() called with no instance of JSCover running."
-            LOGGER.warning(msg)
+                except OSError:
+                    LOGGER.debug("Could not terminate JSCover instance.")
+
+                finally:
+                    self._jscover = None
+
+                # Let other instances use the port again
+                self._release_port(self._port_num)
+
+                # Close any connections we have open to the service
+                self._session.close()
+
+                # Forget the sources we instrumented
+                self._src_cache = {}
+
+            else:
+                msg = "stop() called with no instance of JSCover running."
+                LOGGER.warning(msg)
 
     def instrumented_src(self, rel_path):
         """
@@ -117,6 +213,9 @@ class SrcInstrumenter(object):
         file at `rel_path`, interpreted relative to the
         root URL (configured in the constructor).
 
+        Sources are instrumented only once while the service is running;
+        later calls for the same `rel_path` return the cached result.
+
         Raises a `SrcInstrumenterError` is the service hasn't been
         started or the source could not be retrieved.
         """
@@ -125,40 +224,202 @@ class SrcInstrumenter(object):
         if self._jscover is None:
             raise SrcInstrumenterError("You need to start the JSCover server first.")
 
+        # If we already instrumented this source, don't ask JSCover again
+        cached_src = self._src_cache.get(rel_path)
+        if cached_src is not None:
+            return cached_src
+
+        # Check whether another thread is already asking JSCover
+        # for this source; if not, register that we are.
+        with self._pending_lock:
+
+            # The other thread may have finished since we checked
+            cached_src = self._src_cache.get(rel_path)
+            if cached_src is not None:
+                return cached_src
+
+            pending = self._pending_dict.get(rel_path)
+            is_owner = (pending is None)
+
+            if is_owner:
+                pending = threading.Event()
+                self._pending_dict[rel_path] = pending
+
+        # If another thread is retrieving the source,
+        # wait for its result instead of sending a duplicate request.
+        # Give up if it takes longer than the other thread's
+        # requests could (e.g. because JSCover hangs).
+        if not is_owner:
+            if not pending.wait(self.REQUEST_TIMEOUT * self.MAX_CONNECT_ATTEMPTS):
+                msg = "Timed out waiting for JSCover to instrument '{}'".format(rel_path)
+                raise SrcInstrumenterError(msg)
+
+            cached_src = self._src_cache.get(rel_path)
+            if cached_src is not None:
+                return cached_src
+
+            # The other thread failed, so try again ourselves
+            return self._fetch_instrumented_src(rel_path)
+
+        # Otherwise, retrieve the source and then wake up
+        # any threads waiting for it (whether or not we succeeded)
+        try:
+            return self._fetch_instrumented_src(rel_path)
+
+        finally:
+            with self._pending_lock:
+                del self._pending_dict[rel_path]
+            pending.set()
+
+    def _fetch_instrumented_src(self, rel_path):
+        """
+        Retrieve the instrumented version of the source at `rel_path`
+        from JSCover, retrying on failure, and store it in the cache.
+
+        Raises a `SrcInstrumenterError` if the source could not be retrieved.
+        """
+
         # Get the instrumented version of the source from JSCover
         try:
-            return retry(
+            src = retry(
                 lambda: self._get_src_from_jscover(rel_path),
                 self.MAX_CONNECT_ATTEMPTS,
-                self.WAIT_BETWEEN_ATTEMPTS,
-                recover_func=self.start,
+                self.BASE_DELAY,
+                recover_func=self._restart,
                 num_attempts_before_recover=2,
+                backoff=2,
+                max_wait_sec=self.MAX_DELAY,
+                jitter=self.JITTER,
                 name="Get source from JSCover"
             )
 
-        except requests.exceptions.ConnectionError:
+        # This includes timing out waiting for a hung JSCover
+        except requests.exceptions.RequestException:
+            raise SrcInstrumenterError("Could not connect to JSCover server.")
+
+        self._src_cache[rel_path] = src
+        return src
+
+    def forget_src(self, rel_path):
+        """
+        Discard the cached instrumented version of the source
+        at `rel_path` (e.g. because the source changed), so the
+        next request asks JSCover to instrument it again.
+        """
+        self._src_cache.pop(rel_path, None)
+
+    def instrumented_src_to_file(self, rel_path, file_handle):
+        """
+        Write an instrumented version of the JavaScript source
+        file at `rel_path` to `file_handle`, a file-like object
+        that accepts UTF-8 encoded bytes.
+
+        The source is streamed from JSCover in chunks, so
+        large sources are never held in memory all at once.
+        Unlike `instrumented_src()`, this does not retry
+        (we may already have written part of the source)
+        and does not cache the result.
+
+        Raises a `SrcInstrumenterError` is the service hasn't been
+        started or the source could not be retrieved.
+        """
+
+        # If have not started the service yet, do so now.
+        if self._jscover is None:
+            raise SrcInstrumenterError("You need to start the JSCover server first.")
+
+        # If we already instrumented this source, don't ask JSCover again
+        cached_src = self._src_cache.get(rel_path)
+        if cached_src is not None:
+            file_handle.write(cached_src.encode('utf-8'))
+            return
+
+        url = self._src_url(rel_path)
+
+        try:
+            response = self._session.get(url, stream=True,
+                                         timeout=self.REQUEST_TIMEOUT)
+
+            # Since we are streaming, release the connection back
+            # to the session's pool even if we stop reading early.
+            try:
+
+                # Check the status
+                if response.status_code != 200:
+                    msg = "Could not retrieve url '{}': status code {}".format(url, response.status_code)
+                    raise SrcInstrumenterError(msg)
+
+                for chunk in response.iter_content(self.STREAM_CHUNK_SIZE):
+                    file_handle.write(chunk)
+
+            finally:
+                response.close()
+
+        except requests.exceptions.RequestException:
             raise SrcInstrumenterError("Could not connect to JSCover server.")
 
     @classmethod
     def _random_unused_port(cls):
         """
         Return a random port number not used by any other
-        `SrcInstrumenter` instance.  We won't know if this
-        port is truly open until we try to start the JSCover server.
+        `SrcInstrumenter` instance.
+
+        We check that the port is open by binding a socket to it,
+        which is much cheaper than starting JSCover only to
+        find out that the port is already in use.  Another process could
+        still take the port before JSCover starts, so we won't know
+        for sure until we try to start the JSCover server.
+
+        The chosen port is reserved in `used_ports`; the caller
+        is responsible for discarding it when it is no longer used.
+
+        Raises a `SrcInstrumenterError` if we cannot find an unused
+        port after `MAX_PORT_ATTEMPTS` tries.
         """
-        port_num = None
-        while port_num is None or port_num in cls.used_ports:
+        for _ in range(cls.MAX_PORT_ATTEMPTS):
             port_num = random.randint(10000, 40000)
 
-        # Remember that we tried this port
-        # There's a race condition here -- another instance might
-        # try to start JSCover on `port_num` in between when we
-        # start our process and when we add the port to `used_ports`.
-        # This is harmless, though, since the other process will
-        # get an "address is in use" error and will retry.
-        cls.used_ports.append(port_num)
+            # Check and reserve the port together, so that two
+            # instances starting at the same time cannot both choose it.
+            with cls._used_ports_lock:
+
+                if port_num in cls.used_ports:
+                    continue
+
+                if cls._port_is_free(port_num):
+                    cls.used_ports.add(port_num)
+                    return port_num
 
-        return port_num
+        msg = "Could not find an unused local port after {} attempts".format(cls.MAX_PORT_ATTEMPTS)
+        raise SrcInstrumenterError(msg)
+
+    @classmethod
+    def _release_port(cls, port_num):
+        """
+        Remove `port_num` from `used_ports`, so other
+        instances can use it again.
+        """
+        with cls._used_ports_lock:
+            cls.used_ports.discard(port_num)
+
+    @staticmethod
+    def _port_is_free(port_num):
+        """
+        Return True if we can bind a socket to the local port `port_num`.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+        try:
+            sock.bind(('127.0.0.1', port_num))
+
+        except socket.error:
+            return False
+
+        else:
+            return True
+
+        finally:
+            sock.close()
 
     def _start_jscover(self):
         """
@@ -181,16 +442,26 @@ class SrcInstrumenter(object):
                 '--port={}'.format(port_num),
                 '--document-root={}'.format(self._root_dir)]
 
-        process = self._subprocess.Popen(call, stdout=None,
-                                         stderr=self._subprocess.PIPE)
+        try:
+            process = self._subprocess.Popen(call, stdout=None,
+                                             stderr=self._subprocess.PIPE)
+
+        # If we could not run JSCover at all (e.g. `java` is not installed)
+        # then we are not using the port either.
+        except OSError:
+            self._release_port(port_num)
+            raise
 
-        # If JSCover has a port conflict, it will exit immediately
-        # Check that this hasn't happened
-        if process.poll() is not None:
+        # Wait for JSCover to start accepting connections.
+        # If JSCover has a port conflict, it will exit instead.
+        if not self._wait_until_listening(process, port_num):
 
             # Get the stderr
             _, stderr = process.communicate()
 
+            # We are not using the port, so let other instances try it
+            self._release_port(port_num)
+
             # Raise an exception.  If this is being run in a `_retry` call,
             # then it will wait and retry on a different port.
             msg = "Could not start JSCover: '{}'".format(stderr)
@@ -199,6 +470,51 @@ class SrcInstrumenter(object):
         # Return the process information
         return (port_num, process)
 
+    def _wait_until_listening(self, process, port_num):
+        """
+        Block until the JSCover `process` accepts connections
+        on the local port `port_num`, or until `STARTUP_TIMEOUT`
+        seconds have passed.
+
+        Returns True if the process is accepting connections;
+        returns False if it exited or timed out before it started listening.
+        If it timed out, we terminate the process, so the caller can
+        read its output without blocking.
+        """
+        start_time = time.time()
+
+        while process.poll() is None:
+
+            try:
+                sock = socket.create_connection(('127.0.0.1', port_num),
+                                                timeout=self.STARTUP_POLL_SEC)
+
+            # Not listening yet, so check again after a short wait.
+            # If we time out, let the caller's retries handle it.
+            except socket.error:
+                if time.time() - start_time > self.STARTUP_TIMEOUT:
+                    LOGGER.debug("Timed out waiting for JSCover on port {}".format(port_num))
+                    try:
+                        process.terminate()
+                    except OSError:
+                        LOGGER.debug("Could not terminate JSCover instance.")
+                    return False
+
+                time.sleep(self.STARTUP_POLL_SEC)
+
+            else:
+                sock.close()
+                return True
+
+        return False
+
+    def _src_url(self, rel_path):
+        """
+        Return the URL from which JSCover serves the
+        instrumented version of the source at `rel_path`.
+        """
+        return 'http://127.0.0.1:{}/{}'.format(self._port_num, rel_path)
+
     def _get_src_from_jscover(self, rel_path):
         """
         Retrieve the instrumented JS source file at `rel_path`
@@ -208,19 +524,19 @@ class SrcInstrumenter(object):
         """
 
         # Send an HTTP request for the path
-        url = 'http://127.0.0.1:{}/{}'.format(self._port_num, rel_path)
-        response = self._requests.get(url)
+        url = self._src_url(rel_path)
+        response = self._session.get(url, timeout=self.REQUEST_TIMEOUT)
 
         # Check the status
         if response.status_code != 200:
             msg = "Could not retrieve url '{}': status code {}".format(url, response.status_code)
             raise SrcInstrumenterError(msg)
 
-        # Return a unicode representation of the response
-        if isinstance(response.text, unicode):
-            return response.text
-        else:
-            return response.text.decode('utf-8')
+        # JSCover serves UTF-8.  Setting the encoding explicitly
+        # means `requests` decodes the content once, without
+        # guessing the encoding from the response body.
+        response.encoding = 'utf-8'
+        return response.text
 
 
 class CoverageData(object):
@@ -234,8 +550,9 @@ class CoverageData(object):
 
         # Create a dict mapping source file names to coverage
         # information.  Coverage information is stored
-        # as a dict mapping line numbers to True/False values
-        # indicating whether the line is covered.
+        # as a `(measured, covered)` tuple of sets, where
+        # `measured` contains the line numbers of executable lines
+        # and `covered` contains the line numbers of covered lines.
         self._src_dict = dict()
 
         # Create a dict mapping absolute source paths
@@ -314,7 +631,7 @@ class CoverageData(object):
             raise ValueError("Cover data must be a dictionary")
 
         # For each source file
-        for rel_src, cover_dict in cover_dict.iteritems():
+        for rel_src, src_cover_dict in cover_dict.items():
 
             # Always interpret the `rel_src` as relative;
             # if it has a leading slash, remove it
@@ -331,42 +648,38 @@ class CoverageData(object):
             # that the line is not executable and an integer indicates
             # the number of times the line was executed).
             # If the key is not provided, assume no coverage information.
-            line_list = cover_dict.get('lineData', None)
+            line_list = src_cover_dict.get('lineData', None)
 
             # Only load this source if we have line data;
             # otherwise, ignore it
             if line_list is not None:
 
                 # Line numbers are the indices into the line list
-                # Transform this into a dictionary with keys
-                # that are line numbers and values that are True/False
-                # indicating whether the line is covered.
-                # Ignore `None` values, since these are not executed.
-                cover_dict = {num: line_list[num] > 0
-                              for num in range(len(line_list))
-                              if line_list[num] is not None}
+                # Find the lines that are executable (not `None`)
+                # and the lines that were executed at least once.
+                # `itertools.compress()` selects the covered line numbers
+                # without a Python-level loop.
+                measured = {num for num, count in enumerate(line_list)
+                            if count is not None}
+                covered = set(itertools.compress(itertools.count(), line_list))
 
                 # Ensure that checking/updating the coverage info
                 # is isolated
                 with self.LOAD_LOCK:
 
-                    # Combine the cover dict with any other dicts that we have
-                    # for this source.
-                    existing_dict = self._src_dict.get(full_path)
-
-                    if existing_dict is not None:
+                    # Combine the coverage info with any other info
+                    # that we have for this source.  If the line is
+                    # covered anywhere, call it covered.
+                    existing = self._src_dict.get(full_path)
 
-                        for line_num, is_covered in cover_dict.iteritems():
-
-                            # If the line is covered anywhere, call it covered
-                            # Otherwise, call it uncovered
-                            already_covered = existing_dict.get(line_num, False)
-                            existing_dict[line_num] = is_covered or already_covered
+                    if existing is not None:
+                        existing[0].update(measured)
+                        existing[1].update(covered)
 
                     # If we haven't encountered this source before, then
                     # store the coverage information we just acquired.
                     else:
-                        self._src_dict[full_path] = cover_dict
+                        self._src_dict[full_path] = (measured, covered)
 
     def src_list(self):
         """
@@ -394,28 +707,14 @@ class CoverageData(object):
         return None.
         """
 
-        if full_src_path in self._src_dict:
-
-            # Retrieve the coverage data
-            coverage_data = self._src_dict[full_src_path]
-
-            # If the coverage data is None, that means we didn't
-            # get coverage information for a source we expected.
-            # Report the source as completely uncovered.
-            if coverage_data is None:
-
-                # self.num_file_lines() is guaranteed to return an integer
-                # If the file isn't found, it returns 0, so coverage_data
-                # will be an empty dict.
-                coverage_data = {line_num: False for line_num
-                                 in range(self.num_file_lines(full_src_path))}
-
-            return coverage_data
+        line_sets = self._line_sets(full_src_path)
 
-        # Source not found
-        else:
+        if line_sets is None:
             return None
 
+        else:
+            measured, covered = line_sets
+            return {line_num: (line_num in covered) for line_num in measured}
 
     def rel_src_path(self, full_src_path):
         """
@@ -438,14 +737,9 @@ class CoverageData(object):
         lines_measured = 0
 
         for src_path in self.src_list():
-
-            # `line_dict` has keys that are line numbers
-            # and values that are True/False indicating
-            # whether that line is covered.
-            line_dict = self.line_dict_for_src(src_path)
-            lines_covered += sum([1 if is_covered else 0
-                                  for is_covered in line_dict.values()])
-            lines_measured += len(line_dict.items())
+            measured, covered = self._line_sets(src_path)
+            lines_covered += len(covered)
+            lines_measured += len(measured)
 
         if lines_measured > 0:
             return float(lines_covered) / lines_measured
@@ -461,23 +755,53 @@ class CoverageData(object):
         Returns `None` if no coverage information available
         for `full_src_path`.
         """
-        line_dict = self.line_dict_for_src(full_src_path)
+        line_sets = self._line_sets(full_src_path)
 
-        if line_dict is None:
+        if line_sets is None:
             return None
 
         else:
-            lines_covered = sum([1 if is_covered else 0
-                                 for is_covered in line_dict.values()])
+            measured, covered = line_sets
+            return float(len(covered)) / len(measured)
+
+    def _line_sets(self, full_src_path):
+        """
+        Return a `(measured, covered)` tuple of line number sets
+        for the JS src file located at `full_src_path`.
+
+        If the source file has no coverage information,
+        every line is measured and no line is covered.
 
-            return float(lines_covered) / len(line_dict)
+        If the source file is not in our source list,
+        return None.
+        """
+        if full_src_path in self._src_dict:
+
+            # Retrieve the coverage data
+            line_sets = self._src_dict[full_src_path]
+
+            # If the coverage data is None, that means we didn't
+            # get coverage information for a source we expected.
+            # Report the source as completely uncovered.
+            if line_sets is None:
+
+                # self.num_file_lines() is guaranteed to return an integer
+                # If the file isn't found, it returns 0, so no lines
+                # will be measured.
+                line_sets = (set(range(self.num_file_lines(full_src_path))), set())
+
+            return line_sets
+
+        # Source not found
+        else:
+            return None
 
     def suite_name_list(self):
         """
         Return the list of all test suite names for
         which we have coverage information.
         """
-        return sorted([name for name in self._suite_name_set])
+        return sorted(self._suite_name_set)
 
     @staticmethod
     def num_file_lines(file_path):
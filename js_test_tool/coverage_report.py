@@ -2,7 +2,6 @@
 Report coverage information in different formats.
 """
 
-from abc import ABCMeta, abstractmethod
 from jinja2 import Environment, PackageLoader
 
 # Set up the template environment
@@ -16,10 +15,9 @@ TEMPLATE_ENV = Environment(loader=TEMPLATE_LOADER,
 class BaseCoverageReporter(object):
     """
     Generate coverage reports for JavaScript.
+    Subclasses must override `generate_report()`.
     """
 
-    __metaclass__ = ABCMeta
-
     def __init__(self, output_path):
         """
         Initialize the reporter to write reports to `output_path`.
@@ -43,12 +41,11 @@ class BaseCoverageReporter(object):
         with open(self._output_path, "w") as output_file:
             output_file.write(report_str.encode('utf8'))
 
-    @abstractmethod
     def generate_report(self, coverage_data):
         """
         Return a unicode string report for `coverage_data`.
         """
-        pass
+        raise NotImplementedError
 
 
 class TemplateCoverageReporter(BaseCoverageReporter):
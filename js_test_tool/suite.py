@@ -4,11 +4,25 @@ Load test suite descriptions and generate test runner files.
 import yaml
 import os
 import os.path
+import stat
 from textwrap import dedent
 import re
 import json
 from jinja2 import Environment, PackageLoader
 import urllib
+from collections import OrderedDict
+from js_test_tool.util import map_in_threads
+
+# Use the C implementation of the YAML loader if it is available
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
 
 import logging
 LOGGER = logging.getLogger(__name__)
@@ -45,6 +59,10 @@ class SuiteDescription(object):
     # Supported test runners
     TEST_RUNNERS = ['jasmine', 'jasmine_requirejs']
 
+    # Maximum number of threads used to search
+    # the paths listed in the description at once.
+    MAX_SEARCH_THREADS = 8
+
     def __init__(self, file_handle, root_dir):
         """
         Load the test suite description from a file.
@@ -61,7 +79,7 @@ class SuiteDescription(object):
 
         # Load the YAML file describing the test suite
         try:
-            self._desc_dict = yaml.load(file_handle.read())
+            self._desc_dict = yaml.load(file_handle, Loader=SafeLoader)
 
         except (IOError, ValueError):
             raise SuiteDescriptionError("Could not load suite description file")
@@ -80,11 +98,20 @@ class SuiteDescription(object):
         self._validate_suite_name(self.suite_name())
 
         # Compile exclude/include regular expressions
-        rules = self._desc_dict.get('include_in_page', [])
-        self._include_regex_list = [re.compile(r) for r in rules]
+        self._include_regex = self._combined_regex(
+            self._desc_dict.get('include_in_page', [])
+        )
+        self._exclude_regex = self._combined_regex(
+            self._desc_dict.get('exclude_from_page', [])
+        )
+
+        # Cache whether each path in the description is
+        # a file or a directory, keyed by full path.
+        self._path_type_cache = {}
 
-        rules = self._desc_dict.get('exclude_from_page', [])
-        self._exclude_regex_list = [re.compile(r) for r in rules]
+        # Cache the JS paths we find, keyed by
+        # `(path_list, only_in_page)` tuples.
+        self._paths_cache = {}
 
         # Try to find all paths once, with warnings enabled
         # This way, we print warnings for missing files to the
@@ -230,18 +257,32 @@ class SuiteDescription(object):
         """
 
         # Check if the script matches a rule to always be included
-        for include_regex in self._include_regex_list:
-            if include_regex.match(script_path) is not None:
+        if self._include_regex is not None:
+            if self._include_regex.match(script_path) is not None:
                 return True
 
         # Check if the script matches an exclude rule
-        for exclude_regex in self._exclude_regex_list:
-            if exclude_regex.match(script_path) is not None:
+        if self._exclude_regex is not None:
+            if self._exclude_regex.match(script_path) is not None:
                 return False
 
         # Default is to include it
         return True
 
+    @staticmethod
+    def _combined_regex(rules):
+        """
+        Compile the list of regular expressions `rules` into
+        a single regex that matches if any of the rules match,
+        so we can check all the rules in one call.
+
+        Returns None if `rules` is empty.
+        """
+        if len(rules) > 0:
+            return re.compile('|'.join('(?:{})'.format(r) for r in rules))
+        else:
+            return None
+
     def _js_paths(self, path_list, only_in_page, enable_warnings):
         """
         Find *.js files in `path_list`.  See `_file_paths` for
@@ -253,19 +294,29 @@ class SuiteDescription(object):
 
         If `enable_warnings` is true, then log a warning whenever
         we can't find a file we expect.
+
+        The suite description does not change once loaded, so we
+        search the file system only the first time we are asked
+        for a given `path_list`.
         """
-        paths = self._file_paths(
-            path_list, enable_warnings,
-            include_func=self._is_js_file
-        )
-        if only_in_page:
-            return filter(self._include_in_page, paths)
-        else:
-            return paths
+        key = (tuple(path_list), only_in_page)
+
+        if key not in self._paths_cache:
+            paths = self._file_paths(
+                path_list, enable_warnings,
+                include_func=self._is_js_file
+            )
+            if only_in_page:
+                paths = filter(self._include_in_page, paths)
+
+            self._paths_cache[key] = paths
+
+        # Return a copy so callers cannot modify the cached list
+        return list(self._paths_cache[key])
 
     def _file_paths(self, path_list,
                     enable_warnings,
-                    include_func=lambda file_path: True):
+                    include_func=None):
         """
         Recursively search the directories in `path_list` for
         files that satisfy `include_func`.
@@ -273,6 +324,7 @@ class SuiteDescription(object):
         `path_list` is a list of file and directory paths.
         `include_func` is a function that acccepts a `file_path` argument
         and returns a bool indicating whether to include the file.
+        If `include_func` is None, include every file.
 
         If `enable_warnings` is true, then log a warning whenever
         we can't find a file we expect.
@@ -290,72 +342,156 @@ class SuiteDescription(object):
         Raises a `SuiteDescriptionError` if the directory could not be found.
         """
 
+        # Search each path in `path_list`.  Searching a directory
+        # tree is mostly waiting on the file system, so when there
+        # are several paths, we search them at once in separate threads.
+        # Results are returned in the order of `path_list`.
+        path_groups = map_in_threads(
+            lambda path: self._search_path(path, enable_warnings, include_func),
+            path_list, max_workers=self.MAX_SEARCH_THREADS
+        )
+
         # Create a list of paths to return
         # We use a list instead of a set, even though we
         # want paths to be unique, because we want
         # to preserve the dependency order the user
         # specified.
-        result_paths = []
+        result_paths = [path for group in path_groups for path in group]
 
-        for path in path_list:
+        # Now that we've found the files we're looking for, we
+        # want to return relative paths to our root
+        # (for use in URLs)
+        # Every path we found starts with the root directory,
+        # so we can strip it off instead of calling `os.path.relpath()`,
+        # which looks up the working directory for every path.
+        root_prefix = os.path.join(self._root_dir, '')
+        rel_paths = [
+            os.path.normpath(path[len(root_prefix):])
+            if path.startswith(root_prefix)
+            else os.path.relpath(path, self._root_dir)
+            for path in result_paths
+        ]
 
-            # We use the full path here so that we actually find
-            # the files we're looking for
-            full_path = os.path.join(self._root_dir, path)
+        # Remove duplicates, preserving the order
+        return self._remove_duplicates(rel_paths)
 
-            # If the path is a file and satisfies the include function
-            # then add it to the list.
-            if os.path.isfile(full_path):
-                if include_func(full_path):
-                    result_paths.append(full_path)
+    def _search_path(self, path, enable_warnings, include_func):
+        """
+        Return a list of full paths to the files that satisfy
+        `include_func` at `path`, a file or directory path relative
+        to the root directory.  See `_file_paths` for more information.
+        """
 
-                # This is a user-specified file, so we let the
-                # user know that we are skipping the dependency.
-                elif enable_warnings:
-                    msg = "Skipping '{}' because it does not have a '.js' extension".format(path)
-                    LOGGER.warning(msg)
+        # We use the full path here so that we actually find
+        # the files we're looking for
+        full_path = os.path.join(self._root_dir, path)
 
-            # If the path is a directory, recursively search for JS files
-            elif os.path.isdir(full_path):
+        path_type = self._path_type(full_path)
 
-                # Store all paths within this root directory, so
-                # we can sort them while preserving the order of
-                # the root directories.
-                inner_paths = []
+        # If the path is a file and satisfies the include function
+        # then add it to the list.
+        if path_type == 'file':
+            if include_func is None or include_func(full_path):
+                return [full_path]
 
-                for root_dir, _, filenames in os.walk(full_path):
+            # This is a user-specified file, so we let the
+            # user know that we are skipping the dependency.
+            elif enable_warnings:
+                msg = "Skipping '{}' because it does not have a '.js' extension".format(path)
+                LOGGER.warning(msg)
 
-                    # Look for files that satisfy the include func
-                    for name in filenames:
-                        if include_func(name):
-                            inner_paths.append(os.path.join(root_dir, name))
+        # If the path is a directory, recursively search for JS files
+        elif path_type == 'dir':
 
-                # Sort the paths in this directory in alphabetical order
-                # then add them to the final list.
-                result_paths.extend(sorted(inner_paths, key=str.lower))
+            # Store all paths within this root directory, so
+            # we can sort them while preserving the order of
+            # the root directories.
+            if include_func is None:
+                inner_paths = [
+                    file_path for _, file_path in self._walk_files(full_path)
+                ]
+            else:
+                inner_paths = [
+                    file_path for name, file_path in self._walk_files(full_path)
+                    if include_func(name)
+                ]
 
-            # If it's neither a file nor a directory,
-            # this is a user input error, so log it.
-            elif enable_warnings:
-                msg = "Could not find file or directory at '{}'".format(path)
-                LOGGER.warning(msg)
+            # Sort the paths in this directory in alphabetical order
+            return sorted(inner_paths, key=str.lower)
 
-        # Now that we've found the files we're looking for, we
-        # want to return relative paths to our root
-        # (for use in URLs)
-        rel_paths = [os.path.relpath(path, self._root_dir)
-                     for path in result_paths]
+        # If it's neither a file nor a directory,
+        # this is a user input error, so log it.
+        elif enable_warnings:
+            msg = "Could not find file or directory at '{}'".format(path)
+            LOGGER.warning(msg)
 
-        # Remove duplicates, preserving the order
-        return self._remove_duplicates(rel_paths)
+        return []
+
+    def _path_type(self, full_path):
+        """
+        Return 'file' if `full_path` is a file, 'dir' if it is
+        a directory, and None otherwise.
+
+        We remember the result for each path, so we `stat`
+        each path in the suite description only once.
+        """
+        if full_path not in self._path_type_cache:
+
+            try:
+                mode = os.stat(full_path).st_mode
+            except OSError:
+                path_type = None
+            else:
+                if stat.S_ISREG(mode):
+                    path_type = 'file'
+                elif stat.S_ISDIR(mode):
+                    path_type = 'dir'
+                else:
+                    path_type = None
+
+            self._path_type_cache[full_path] = path_type
+
+        return self._path_type_cache[full_path]
+
+    @classmethod
+    def _walk_files(cls, dir_path):
+        """
+        Recursively find the files in the directory at `dir_path`,
+        yielding `(name, path)` tuples.
+
+        Like `os.walk`, this does not descend into symbolic links
+        to directories, and skips directories and entries we
+        cannot read (e.g. because of their permissions, or because
+        they were deleted while we were searching).
+        We use `scandir` so that the file type of each entry comes
+        from the directory listing instead of a separate `stat` call.
+        """
+        try:
+            entry_list = list(scandir(dir_path))
+        except OSError:
+            return
+
+        for entry in entry_list:
+
+            try:
+                is_dir = entry.is_dir()
+                is_dir_link = is_dir and entry.is_symlink()
+            except OSError:
+                continue
+
+            if is_dir:
+                if not is_dir_link:
+                    for result in cls._walk_files(entry.path):
+                        yield result
+            else:
+                yield (entry.name, entry.path)
 
     @staticmethod
     def _is_js_file(file_path):
         """
         Returns True only if the file at `file_path` has a .js extension.
         """
-        _, ext = os.path.splitext(file_path)
-        return ext == '.js'
+        return file_path.endswith('.js')
 
     @staticmethod
     def _remove_duplicates(path_list):
@@ -363,16 +499,7 @@ class SuiteDescription(object):
         Return a list of paths with duplicates removed,
         preserving the order in `path_list`.
         """
-        already_found = []
-        result = []
-
-        for path in path_list:
-
-            if not path in already_found:
-                result.append(path)
-                already_found.append(path)
-
-        return result
+        return list(OrderedDict.fromkeys(path_list))
 
     @classmethod
     def _validate_description(cls, desc_dict):
@@ -509,6 +636,13 @@ class SuiteRenderer(object):
         """
         self._dev_mode = dev_mode
 
+        # Load and compile the templates once, rather than
+        # looking them up each time we render a page.
+        self._template_dict = {
+            test_runner: TEMPLATE_ENV.get_template(template_name)
+            for test_runner, template_name in self.TEMPLATE_DICT.iteritems()
+        }
+
     def render_to_string(self, suite_name, suite_desc):
         """
         Given a `test_suite_desc` (`TestSuiteDescription` instance),
@@ -525,10 +659,10 @@ class SuiteRenderer(object):
 
         # Get the test runner template
         test_runner = suite_desc.test_runner()
-        template_name = self.TEMPLATE_DICT.get(test_runner)
+        template = self._template_dict.get(test_runner)
 
         # If we have no template for this name, raise an exception
-        if template_name is None:
+        if template is None:
             msg = "No template defined for test runner '{}'".format(test_runner)
             raise SuiteRendererError(msg)
 
@@ -547,7 +681,7 @@ class SuiteRenderer(object):
 
         # Render the template
         try:
-            html = self.render_template(template_name, template_context)
+            html = self.render_template(template, template_context)
         except Exception as ex:
             msg = "Error occurred while rendering test runner page: {}".format(ex)
             raise SuiteRendererError(msg)
@@ -555,10 +689,9 @@ class SuiteRenderer(object):
         return html
 
     @staticmethod
-    def render_template(template_name, context):
+    def render_template(template, context):
         """
         Render `template` (a Jinja2 `Template`) using `context`
         (a `dict`) and return the resulting unicode string.
         """
-        template = TEMPLATE_ENV.get_template(template_name)
         return template.render(context)
@@ -5,22 +5,35 @@ Serve test runner pages and included JavaScript files on a local port.
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 from SocketServer import ThreadingMixIn
 import threading
+import Queue
 import re
 import pkg_resources
 import os.path
 import logging
-import json
-import time
 import mimetypes
 import shutil
 import socket
-from StringIO import StringIO
+import select
+import errno
+import sys
+from cStringIO import StringIO
 from abc import ABCMeta, abstractmethod
 from js_test_tool.coverage import SrcInstrumenter, SrcInstrumenterError, CoverageData
+from js_test_tool.util import map_in_threads, WorkerPool, WorkerPoolStoppedError
+
+# Use simplejson (with its C speedups) to parse
+# coverage data if it is available
+try:
+    import simplejson as json
+except ImportError:
+    import json
 
 
 LOGGER = logging.getLogger(__name__)
 
+# Load the MIME type tables now, so the first request doesn't have to
+mimetypes.init()
+
 
 class TimeoutError(Exception):
     """
@@ -49,7 +62,12 @@ class SuitePageServer(ThreadingMixIn, HTTPServer):
     Serve test suite pages and included JavaScript files.
     """
 
-    protocol_version = 'HTTP/1.1'
+    # Number of threads handling requests.  Rather than starting
+    # a thread for each connection, we queue connections until
+    # one of these threads is free.  Each keep-alive connection
+    # holds a thread until it closes or times out, so this is
+    # comfortably more than the few connections each browser opens.
+    NUM_REQUEST_THREADS = 32
 
     # Request response timeout
     timeout = 5
@@ -58,9 +76,20 @@ class SuitePageServer(ThreadingMixIn, HTTPServer):
     # back to the server before timing out.
     COVERAGE_TIMEOUT = 2.0
 
-    # Amount of time to wait between checks that the we
-    # have all the coverage info
-    COVERAGE_WAIT_TIME = 0.1
+    # Number of threads (shared by all suites) used to instrument
+    # source files in the background when the server starts.
+    # These are separate from the threads serving requests,
+    # so requests don't queue behind the sources we prefetch.
+    NUM_PREFETCH_THREADS = 4
+
+    # Number of threads that ask JSCover for instrumented sources
+    # on behalf of requests.  Requests wait for these threads,
+    # so a slow JSCover can't hold up more than this many calls.
+    NUM_INSTR_THREADS = 4
+
+    # Maximum number of JSCover services to start or stop at once.
+    # Each one starts a JVM, so we limit how many compete for the CPU.
+    MAX_INSTR_START_THREADS = 8
 
     # Returns the `CoverageData` instance used by the server
     # to store coverage data received from the test suites.
@@ -90,16 +119,64 @@ class SuitePageServer(ThreadingMixIn, HTTPServer):
         # (One for each suite description)
         self.src_instr_dict = {}
 
+        # Notified by the coverage handler once every suite has
+        # reported, so we can wait for coverage data without polling.
+        self._coverage_cond = threading.Condition()
+
+        # Names of suites that have not yet reported coverage.
+        # Suites are removed as their reports arrive.
+        self._pending_suites = set(self.desc_dict.keys())
+
+        # Page handlers shared by all requests, keyed by the
+        # first segment of the URL paths they handle.
+        # These are created when the server starts.
+        self.page_handler_dict = {}
+
+        # Thread running the server loop, once started
+        self._server_thread = None
+
+        # Connections waiting for a request thread,
+        # and the threads that handle them.
+        self._request_queue = Queue.Queue()
+        self._request_threads = []
+
+        # Connections the request threads are handling, so we can
+        # close them when the server stops, and a flag telling
+        # request threads to close any connection they pick up.
+        self._active_requests = set()
+        self._active_lock = threading.Lock()
+        self._is_stopping = False
+
+        # Threads instrumenting sources in the background,
+        # the tasks we gave them, and an event telling them to stop early.
+        # (started only if we are collecting coverage)
+        self._prefetch_pool = WorkerPool(self.NUM_PREFETCH_THREADS)
+        self._prefetch_tasks = []
+        self._prefetch_stop = threading.Event()
+
+        # Threads instrumenting sources for requests
+        # (started only if we are collecting coverage)
+        self._instr_pool = WorkerPool(self.NUM_INSTR_THREADS)
+
         address = ('0.0.0.0', port)
         HTTPServer.__init__(self, address, SuitePageRequestHandler)
 
+        # Now that we're bound to a port, the URLs are fixed
+        host, port = self.server_address
+        self._root_url = u"http://{}:{}/".format(host, port)
+        self._suite_url_list = [self._root_url + u'suite/' + suite_name
+                                for suite_name in self.desc_dict.keys()]
+
+        # `shutdown()` writes to this pipe to wake up the
+        # server loop, so the loop never needs to poll.
+        self._shutdown_read_fd, self._shutdown_write_fd = os.pipe()
+        self._shutdown_request = False
+        self._is_shut_down = threading.Event()
+
     def start(self):
         """
         Start serving pages on an open local port.
         """
-        server_thread = threading.Thread(target=self.serve_forever)
-        server_thread.daemon = True
-        server_thread.start()
 
         # If we're collecting coverage information
         if self._jscover_path is not None:
@@ -107,57 +184,258 @@ class SuitePageServer(ThreadingMixIn, HTTPServer):
             # Create an object to store coverage data we receive
             self.coverage_data = CoverageData()
 
-            # Start each SrcInstrumenter instance if we know where JSCover is
+            # Create a SrcInstrumenter instance for each suite
+            instr_list = []
+            src_paths_dict = {}
             for suite_name, desc in self.desc_dict.iteritems():
+                root_dir = desc.root_dir()
+                src_paths = desc.src_paths()
+                src_paths_dict[suite_name] = src_paths
 
                 # Inform the coverage data that we expect this source
                 # (report it as 0% if no info received).
-                for rel_path in desc.src_paths():
-                    self.coverage_data.add_expected_src(desc.root_dir(), rel_path)
+                for rel_path in src_paths:
+                    self.coverage_data.add_expected_src(root_dir, rel_path)
 
                 # Create an instrumenter serving files
                 # in the suite description root directory
-                instr = SrcInstrumenter(desc.root_dir(),
+                instr = SrcInstrumenter(root_dir,
                                         tool_path=self._jscover_path)
+                instr_list.append((suite_name, instr))
 
-                # Start the instrumenter service
+            # Start the instrumenter services.  Each one waits for
+            # a JVM to start up, so we start several at once.
+            # The ones that started are recorded as they start.
+            def _start_instr(item):
+                suite_name, instr = item
                 instr.start()
 
                 # Associate the instrumenter with its suite description
                 self.src_instr_dict[suite_name] = instr
 
+            try:
+                map_in_threads(_start_instr, instr_list,
+                               max_workers=self.MAX_INSTR_START_THREADS)
+
+            # If any fail, stop the ones that started before re-raising,
+            # since the caller won't call `stop()` if we fail to start.
+            except BaseException:
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                map_in_threads(lambda instr: instr.stop(), self.src_instr_dict.values(),
+                               max_workers=self.MAX_INSTR_START_THREADS)
+                self.src_instr_dict = {}
+                raise exc_type, exc_value, exc_traceback
+
+            self._instr_pool.start()
+            self._prefetch_pool.start()
+
+            # Start instrumenting the sources, so they are ready
+            # by the time the browser asks for them.
+            for suite_name, instr in instr_list:
+                self._prefetch_instrumented_src(instr, src_paths_dict[suite_name])
+
         else:
             self.src_instr_dict = {}
 
+        # Create the page handlers once the instrumenters
+        # and coverage data they depend on exist.
+        # Group them by path prefix, keeping their order
+        # within each group.
+        page_handler_dict = {}
+        for handler in self._create_page_handlers():
+            page_handler_dict.setdefault(handler.PATH_PREFIX, []).append(handler)
+        self.page_handler_dict = page_handler_dict
+
+        # Start the threads that handle requests.
+        # These don't keep the process alive after the server stops
+        # (e.g. while waiting on an idle keep-alive connection).
+        for _ in range(self.NUM_REQUEST_THREADS):
+            thread = threading.Thread(target=self._handle_queued_requests)
+            thread.daemon = True
+            thread.start()
+            self._request_threads.append(thread)
+
+        # Start handling requests.  The socket is already
+        # listening, so any early connections are queued.
+        self._server_thread = threading.Thread(target=self.serve_forever)
+        self._server_thread.daemon = True
+        self._server_thread.start()
+
     def stop(self):
         """
         Stop the server and free the port.
         """
 
-        # Stop each instrumenter service that we started
-        for instr in self.src_instr_dict.values():
-            instr.stop()
+        # Stop instrumenting sources in the background.
+        # Each thread finishes at most the source it is working on.
+        self._prefetch_stop.set()
+
+        # Stop each instrumenter service that we started.
+        # These are independent processes, so we stop several at once.
+        # We do this before waiting for the threads that call them,
+        # so a hung JSCover cannot keep those threads (and us) waiting:
+        # their calls fail, and a stopped instrumenter does not restart.
+        map_in_threads(lambda instr: instr.stop(), self.src_instr_dict.values(),
+                       max_workers=self.MAX_INSTR_START_THREADS)
+
+        # Wait for the background threads to finish.  Their calls
+        # fail now that the instrumenters have stopped (or time out,
+        # if JSCover hangs), and they skip any sources still queued.
+        self._prefetch_pool.stop()
+
+        # Likewise, wait for any requests for instrumented sources
+        # to finish.  Requests still waiting for them will serve
+        # the un-instrumented sources instead.
+        self._instr_pool.stop()
+
+        # Free the memory used by cached pages
+        for handler_list in self.page_handler_dict.values():
+            for handler in handler_list:
+                handler.clear_cache()
 
         # Stop the page server and free the port
-        self.shutdown()
+        # (If we never started serving, there is nothing to shut down.)
+        # It is safe to call `stop()` more than once.
+        if self._server_thread is not None:
+            self.shutdown()
+            self._server_thread = None
         self.socket.close()
 
+        # Tell each request thread to exit once it finishes
+        # the connections already queued.
+        for _ in self._request_threads:
+            self._request_queue.put(None)
+
+        # Close the connections the request threads are handling,
+        # so threads waiting on idle keep-alive connections
+        # finish right away instead of when the connection times out.
+        with self._active_lock:
+            self._is_stopping = True
+            for request in self._active_requests:
+                self._close_request(request)
+
+        # Wait for the request threads to exit, so they don't
+        # outlive the server (e.g. during interpreter shutdown).
+        for thread in self._request_threads:
+            thread.join()
+        self._request_threads = []
+
+        if self._shutdown_read_fd is not None:
+            os.close(self._shutdown_read_fd)
+            os.close(self._shutdown_write_fd)
+            self._shutdown_read_fd = self._shutdown_write_fd = None
+
+    def serve_forever(self, poll_interval=None):
+        """
+        Handle requests until `shutdown()` is called.
+
+        The base implementation wakes up every `poll_interval` seconds
+        to check whether it should shut down, which delays `stop()`
+        by up to half a second.  Instead, we wait for either a request
+        or a byte written to the shutdown pipe, so we stop immediately
+        and never wake up while idle.  `poll_interval` is ignored.
+        """
+        self._is_shut_down.clear()
+
+        try:
+            while not self._shutdown_request:
+
+                try:
+                    readable, _, _ = select.select(
+                        [self, self._shutdown_read_fd], [], []
+                    )
+
+                # Restart the call if it was interrupted by a signal
+                except select.error as err:
+                    if err.args[0] == errno.EINTR:
+                        continue
+                    raise
+
+                # Consume the wake-up byte, if we got one
+                if self._shutdown_read_fd in readable:
+                    os.read(self._shutdown_read_fd, 1)
+
+                # Don't accept any more requests once asked to stop
+                if self._shutdown_request:
+                    break
+
+                if self in readable:
+                    self._handle_request_noblock()
+
+        finally:
+            self._shutdown_request = False
+            self._is_shut_down.set()
+
+    def shutdown(self):
+        """
+        Stop the `serve_forever()` loop, and block until it finishes.
+        Must be called while `serve_forever()` is running in another
+        thread, or it will deadlock.
+        """
+        self._shutdown_request = True
+        os.write(self._shutdown_write_fd, b'x')
+        self._is_shut_down.wait()
+
+    def process_request(self, request, client_address):
+        """
+        Queue the connection for one of the request threads,
+        instead of starting a new thread for it.
+        """
+        self._request_queue.put((request, client_address))
+
+    def _handle_queued_requests(self):
+        """
+        Handle queued connections until we receive None.
+        """
+        while True:
+            item = self._request_queue.get()
+
+            if item is None:
+                return
+
+            # If the server is stopping, close the connection
+            # instead of waiting for requests on it
+            request, client_address = item
+            with self._active_lock:
+                self._active_requests.add(request)
+                if self._is_stopping:
+                    self._close_request(request)
+
+            # Handles the request, then shuts down
+            # and closes the connection (even on error).
+            try:
+                self.process_request_thread(request, client_address)
+            finally:
+                with self._active_lock:
+                    self._active_requests.discard(request)
+
+    @staticmethod
+    def _close_request(request):
+        """
+        Shut down the connection `request` (a socket), so that
+        the thread handling it stops waiting for requests.
+        """
+        try:
+            request.shutdown(socket.SHUT_RDWR)
+
+        # The client may have already closed the connection
+        except socket.error:
+            pass
+
     def suite_url_list(self):
         """
         Return a list of URLs (unicode strings), where each URL
         is a test suite page containing the JS code to run
         the JavaScript tests.
         """
-        return [self.root_url() + u'suite/{}'.format(suite_name)
-                for suite_name in self.desc_dict.keys()]
+        return list(self._suite_url_list)
 
     def root_url(self):
         """
         Return the root URL (including host and port) for the server
         as a unicode string.
         """
-        host, port = self.server_address
-        return u"http://{}:{}/".format(host, port)
+        return self._root_url
 
     def all_coverage_data(self):
         """
@@ -180,78 +458,142 @@ class SuitePageServer(ThreadingMixIn, HTTPServer):
         """
         Block until `success_func` returns True.
         `success_func` should be a lambda with no argument.
+
+        `success_func` is re-evaluated each time the coverage
+        condition is notified.  Raises a `TimeoutError` if it
+        is still False after `COVERAGE_TIMEOUT` seconds.
         """
 
-        # Remember when we started
-        start_time = time.time()
+        # In Python 2, a timed `Condition.wait()` polls in steps of
+        # up to 50 ms, which would delay noticing the last report.
+        # Instead, we wait without a timeout (which wakes up as soon
+        # as we're notified) and use a timer to notify us when
+        # we run out of time.
+        timed_out = threading.Event()
+
+        def _time_out():
+            with self._coverage_cond:
+                timed_out.set()
+                self._coverage_cond.notify_all()
 
-        # Until we are successful
-        while not success_func():
+        timer = threading.Timer(self.COVERAGE_TIMEOUT, _time_out)
+        timer.daemon = True
+        timer.start()
+
+        try:
+            with self._coverage_cond:
 
-            # See if we've timed out
-            if time.time() - start_time > self.COVERAGE_TIMEOUT:
-                raise TimeoutError()
+                # Until we are successful
+                while not success_func():
 
-            # Wait a little bit before checking again
-            time.sleep(self.COVERAGE_WAIT_TIME)
+                    # See if we've timed out
+                    if timed_out.is_set():
+                        raise TimeoutError()
+
+                    # Sleep until a suite reports or we run out of time
+                    self._coverage_cond.wait()
+
+        finally:
+            timer.cancel()
 
     def _has_all_coverage(self):
         """
         Returns True if and only if every suite
         has coverage information.
         """
-        # Retrieve the indices of each suite for which coverage
-        # information was reported.
-        suite_name_list = self.coverage_data.suite_name_list()
+        return len(self._pending_suites) == 0
 
-        # Check that we have an index for every suite
-        # (This is not the most efficient way to do this --
-        # if it becomes a bottleneck, we can revisit.)
-        return (sorted(suite_name_list) == sorted(self.desc_dict.keys()))
+    def _prefetch_instrumented_src(self, instr, src_paths):
+        """
+        Ask `instr` (a `SrcInstrumenter`) to instrument each of the
+        paths in `src_paths` on the background prefetch threads.
+        The instrumenter caches the results, so later requests
+        for the sources don't wait on JSCover.
+        """
+        for rel_path in src_paths:
+            task = self._prefetch_pool.submit(self._prefetch_src, instr, rel_path)
+            self._prefetch_tasks.append(task)
 
-    @classmethod
-    def _suite_dict_from_list(cls, suite_desc_list):
+    def _prefetch_src(self, instr, rel_path):
         """
-        Given a list of `SuiteDescription` instances, construct
-        a dictionary mapping suite names to the instances.
+        Ask `instr` to instrument the source at `rel_path`,
+        unless the server is stopping.
+        """
+        if self._prefetch_stop.is_set():
+            return
 
-        Raises a `DuplicateSuiteNameError` if two suites have
-        the same name.
+        # If this fails, the source will be instrumented
+        # (or served uninstrumented) when it is requested.
+        try:
+            instr.instrumented_src(rel_path)
+        except SrcInstrumenterError as err:
+            msg = "Could not prefetch instrumented '{}': {}".format(rel_path, err)
+            LOGGER.debug(msg)
+
+    def _create_page_handlers(self):
+        """
+        Return the list of page handlers, in the order
+        they should be tried for each request.
         """
-        suite_dict = {
-            suite.suite_name(): suite
-            for suite in suite_desc_list
-        }
 
-        # Check that we haven't repeated keys
-        duplicates = cls._duplicates([suite.suite_name() for suite in suite_desc_list])
+        # We always handle suite runner pages, and
+        # the runner dependencies (e.g. jasmine.js)
+        page_handlers = [SuitePageHandler(self.renderer, self.desc_dict),
+                         RunnerPageHandler()]
 
-        if len(duplicates) > 0:
-            msg = "Duplicate suite name(s): {}".format(",".join(duplicates))
-            raise DuplicateSuiteNameError(msg)
+        # If we are configured for coverage, add another handler
+        # to serve instrumented versions of the source files.
+        if len(self.src_instr_dict) > 0:
 
-        return suite_dict
+            # Create the handler to serve instrumented JS pages
+            instr_src_handler = InstrumentedSrcPageHandler(self.desc_dict,
+                                                           self.src_instr_dict,
+                                                           self._instr_pool)
+            page_handlers.append(instr_src_handler)
+
+            # Create a handler to store coverage data POSTed back
+            # to the server from the client.
+            store_coverage_handler = StoreCoveragePageHandler(self.desc_dict,
+                                                              self.coverage_data,
+                                                              self._coverage_cond,
+                                                              self._pending_suites)
+            page_handlers.append(store_coverage_handler)
+
+        # We always serve dependencies.  If running with coverage,
+        # the instrumented src handler will intercept source files.
+        # Serving the un-instrumented version is the fallback, and
+        # will still be used for library/spec dependencies.
+        page_handlers.append(DependencyPageHandler(self.desc_dict))
+
+        return page_handlers
 
     @classmethod
-    def _duplicates(cls, name_list):
+    def _suite_dict_from_list(cls, suite_desc_list):
         """
-        Given a list of strings, return a set of duplicates in the list.
+        Given a list of `SuiteDescription` instances, construct
+        a dictionary mapping suite names to the instances.
+
+        Raises a `DuplicateSuiteNameError` if two suites have
+        the same name.
         """
-        seen = set()
+        suite_dict = {}
         duplicates = set()
 
-        for name in name_list:
-
-            # Check if we've already seen the name; if so, add it
-            # to the list of duplicates
-            if name in seen:
-                duplicates.add(name)
+        # Build the dict in one pass, noting any names we've already seen.
+        # We keep going so we can report every duplicate at once.
+        for suite in suite_desc_list:
+            suite_name = suite.suite_name()
 
-            # Add the name to the list of names we've already seen
+            if suite_name in suite_dict:
+                duplicates.add(suite_name)
             else:
-                seen.add(name)
+                suite_dict[suite_name] = suite
 
-        return duplicates
+        if len(duplicates) > 0:
+            msg = "Duplicate suite name(s): {}".format(",".join(sorted(duplicates)))
+            raise DuplicateSuiteNameError(msg)
+
+        return suite_dict
 
 
 class BasePageHandler(object):
@@ -265,13 +607,32 @@ class BasePageHandler(object):
 
     # HTTP methods handled by this class
     # The default is to handle only GET methods
-    HTTP_METHODS = ["GET"]
+    HTTP_METHODS = frozenset(["GET"])
 
     # Subclasses override this to provide a regex that matches
     # URL paths.  Should be a `re` module compiled regex.
     PATH_REGEX = None
 
-    def page_contents(self, path, method, content):
+    # Subclasses override this to provide the first segment
+    # of the URL paths they handle (e.g. "suite" for "/suite/...").
+    # Requests are only passed to handlers with a matching prefix.
+    PATH_PREFIX = None
+
+    # Map file name extensions (e.g. ".js" or ".tar.gz")
+    # to the MIME types we guessed.
+    # This is shared by all handlers.
+    _mime_type_cache = {}
+    MAX_MIME_TYPE_CACHE_SIZE = 64
+
+    # MIME types (in addition to text/* that we serve as UTF-8 encoded)
+    TEXT_MIME_TYPES = [
+        'application/json',
+        'application/javascript',
+        'application/ecmascript',
+        'application/xml',
+    ]
+
+    def page_contents(self, path, method, content, parsed_dict=None):
         """
         Returns a `(content, mime_type)` tuple if the page
         could be loaded.  Otherwise, returns `(None, None)`.
@@ -283,32 +644,78 @@ class BasePageHandler(object):
 
         `method` is the HTTP method used to load the page (e.g. "GET" or "POST")
         `content` is the content of the HTTP request.
+
+        `parsed_dict` is an optional dict shared by the handlers
+        trying the same request, mapping `parse_key()` values to
+        the arguments parsed from `path`.  Handlers that parse
+        paths the same way then parse each path only once.
         """
 
         # Check that we handle this kind of request
         if method in self.HTTP_METHODS:
 
-            # Check whether this handler matches the URL path
-            result = self.PATH_REGEX.match(path)
+            # Check whether this handler matches the URL path,
+            # re-using the result from a previous handler if we can
+            if parsed_dict is None:
+                args = self.parse_path(path)
+
+            else:
+                key = self.parse_key()
+                if key in parsed_dict:
+                    args = parsed_dict[key]
+                else:
+                    args = self.parse_path(path)
+                    parsed_dict[key] = args
 
             # If this is not a match, return None
-            if result is None:
+            if args is None:
                 return (None, None)
 
             # If we do match, attempt to load the page.
+            page_contents = self.load_page(method, content, *args)
+
+            # If we couldn't load it (e.g. an uninstrumented source),
+            # another handler may, so don't bother with the MIME type.
+            if page_contents is None:
+                return (None, None)
+
             else:
-                page_contents = self.load_page(method, content, *result.groups())
-                mime_type = self.mime_type(method, content, *result.groups())
+                mime_type = self.mime_type(method, content, *args)
                 return (page_contents, mime_type)
 
         else:
             return (None, None)
 
+    def parse_path(self, path):
+        """
+        Return a tuple of arguments parsed from the URL `path`,
+        or None if this handler does not handle the path.
+
+        The default implementation returns the groups
+        matched by `PATH_REGEX`.
+        """
+        result = self.PATH_REGEX.match(path)
+
+        if result is None:
+            return None
+        else:
+            return result.groups()
+
+    def parse_key(self):
+        """
+        Return a key identifying how this handler parses paths.
+        Handlers with equal keys return the same result
+        from `parse_path()` for every path.
+
+        The default implementation uses `PATH_REGEX`.
+        """
+        return self.PATH_REGEX
+
     @abstractmethod
     def load_page(self, method, content, *args):
         """
         Subclasses override this to load the page.
-        `args` is a list of arguments parsed using the regular expression.
+        `args` is a list of arguments parsed from the URL path.
 
         If the page cannot be loaded (e.g. accessing a file that
         does not exist), then return None.
@@ -316,7 +723,8 @@ class BasePageHandler(object):
         `method` is the HTTP method used to load the page (e.g. "GET" or "POST")
         `content` is the content of the HTTP request.
 
-        Returns a file-like object from which to read the page content.
+        Returns a file-like object from which to read the page content
+        as a byte string (the content is written to the response as-is).
         """
         pass
 
@@ -330,15 +738,41 @@ class BasePageHandler(object):
         """
         pass
 
-    @staticmethod
-    def guess_mime_type(url):
+    def clear_cache(self):
+        """
+        Discard any pages the handler has cached.
+        The server calls this when it stops.
+
+        The default implementation does nothing.
+        """
+        pass
+
+    @classmethod
+    def guess_mime_type(cls, url):
         """
         Guess the mime type for a given URL by its
         extension; default to text/plain.
         """
-        mime_type, _ = mimetypes.guess_type(url)
+
+        # `mimetypes` looks at every extension of the file name
+        # (e.g. "a.tar.gz" is "application/x-tar" with gzip encoding),
+        # so cache on everything from the first "." of the name.
+        basename = os.path.basename(url)
+        dot_index = basename.find('.')
+        suffix = basename[dot_index:] if dot_index >= 0 else ''
+
+        mime_type = cls._mime_type_cache.get(suffix)
+
         if mime_type is None:
-            mime_type = 'text/plain'
+            mime_type, _ = mimetypes.guess_type('file' + suffix)
+            if mime_type is None:
+                mime_type = 'text/plain'
+
+            # Suites serve only a few kinds of files, so the cache
+            # stays small, but don't let unusual URLs grow it.
+            if len(cls._mime_type_cache) < cls.MAX_MIME_TYPE_CACHE_SIZE:
+                cls._mime_type_cache[suffix] = mime_type
+
         return mime_type
 
     @staticmethod
@@ -365,8 +799,7 @@ class SuitePageHandler(BasePageHandler):
     """
 
     # Handle requests to /suite/NAME/
-    # Ignore GET parameters
-    PATH_REGEX = re.compile(r'^/suite/([^?/]+)/?(\?.*)?$')
+    PATH_PREFIX = 'suite'
 
     def __init__(self, renderer, desc_dict):
         """
@@ -378,6 +811,42 @@ class SuitePageHandler(BasePageHandler):
         self._renderer = renderer
         self._desc_dict = desc_dict
 
+        # Map suite names to rendered pages, encoded as UTF-8.
+        # Suite descriptions don't change while the server is
+        # running, so we only need to render and encode each page once.
+        self._page_cache = {}
+
+        # Held while rendering, so concurrent requests for a page
+        # that isn't cached yet render it only once.
+        self._render_lock = threading.Lock()
+
+    def parse_path(self, path):
+        """
+        Parse the suite name, ignoring any GET parameters
+        and a trailing slash in the URL.
+
+        Every request for a suite page or one of its includes
+        reaches this handler, so we split the string instead
+        of matching a regex.
+        """
+
+        # Strip GET parameters, then split into
+        # ['', 'suite', SUITE_NAME] or ['', 'suite', SUITE_NAME, '']
+        parts = path.split('?', 1)[0].split('/')
+
+        if (len(parts) in (3, 4) and parts[0] == '' and parts[1] == 'suite'
+                and parts[2] != '' and parts[3:] in ([], [''])):
+            return (parts[2],)
+
+        else:
+            return None
+
+    def parse_key(self):
+        """
+        Suite page paths are parsed differently from include paths.
+        """
+        return SuitePageHandler
+
     def load_page(self, method, content, *args):
         """
         Render the suite runner page.
@@ -393,10 +862,24 @@ class SuitePageHandler(BasePageHandler):
         if suite_desc is None:
             return None
 
-        # Otherwise, render the page
+        # Otherwise, render the page (if we haven't already)
         else:
-            page = self._renderer.render_to_string(suite_name, suite_desc)
-            return self.safe_str_buffer(page)
+            page = self._page_cache.get(suite_name)
+
+            if page is None:
+                with self._render_lock:
+
+                    # Another request may have rendered the page
+                    # while we were waiting for the lock
+                    page = self._page_cache.get(suite_name)
+
+                    if page is None:
+                        page = self._renderer.render_to_string(suite_name, suite_desc)
+                        if isinstance(page, unicode):
+                            page = page.encode('utf-8')
+                        self._page_cache[suite_name] = page
+
+            return StringIO(page)
 
     def mime_type(self, method, content, *args):
         """
@@ -412,8 +895,21 @@ class RunnerPageHandler(BasePageHandler):
     """
 
     # Handle requests to /runner/ pages, ignoring
-    # GET parameters
-    PATH_REGEX = re.compile(r'^/runner/([^\?]+).*$')
+    # GET parameters.  `match()` only needs to match the
+    # start of the path, so we don't match the parameters.
+    PATH_REGEX = re.compile(r'^/runner/([^?]+)')
+    PATH_PREFIX = 'runner'
+
+    def __init__(self):
+        """
+        Initialize the runner page handler.
+        """
+        super(RunnerPageHandler, self).__init__()
+
+        # Map resource paths to their contents (byte strings).
+        # Runner resources never change while the server is
+        # running, so we only load each one once.
+        self._cache = {}
 
     def load_page(self, method, content, *args):
         """
@@ -423,18 +919,26 @@ class RunnerPageHandler(BasePageHandler):
         # Only arg should be the relative path
         rel_path = os.path.join('runner', args[0])
 
-        # Attempt to load the package resource
-        try:
-            content = pkg_resources.resource_string('js_test_tool', rel_path)
+        # Check whether we've already loaded the resource
+        content = self._cache.get(rel_path)
 
-        # If we could not load it, return None
-        except BaseException:
-            return None
+        if content is None:
 
-        # If we successfully loaded it, return the content
-        # as a file-like object.
-        else:
-            return self.safe_str_buffer(content)
+            # Attempt to load the package resource
+            try:
+                content = pkg_resources.resource_string('js_test_tool', rel_path)
+
+            # If we could not load it, return None
+            except BaseException:
+                return None
+
+            # Remember it for next time.  Assigning to a dict is atomic,
+            # so concurrent requests at worst load the resource twice.
+            self._cache[rel_path] = content
+
+        # Package resources are already byte strings,
+        # so we can serve them without re-encoding.
+        return StringIO(content)
 
     def mime_type(self, method, content, *args):
         """
@@ -443,22 +947,55 @@ class RunnerPageHandler(BasePageHandler):
         return self.guess_mime_type(args[0])
 
 
-class DependencyPageHandler(BasePageHandler):
+class IncludePageHandler(BasePageHandler):
+    """
+    Abstract base class for handlers of paths of the form
+    `/suite/SUITE_NAME/include/REL_PATH`, where `REL_PATH` is
+    the path to a dependency relative to the suite's root directory.
+    """
+
+    PATH_PREFIX = 'suite'
+
+    def parse_path(self, path):
+        """
+        Parse the suite name and relative path,
+        ignoring any GET parameters in the URL.
+
+        This is a hot path (a suite page can include many files),
+        so we split the string instead of matching a regex.
+        """
+
+        # Strip GET parameters, then split into
+        # ['', 'suite', SUITE_NAME, 'include', REL_PATH]
+        parts = path.split('?', 1)[0].split('/', 4)
+
+        if (len(parts) == 5 and parts[0] == '' and parts[1] == 'suite'
+                and parts[2] != '' and parts[3] == 'include' and parts[4] != ''):
+            return (parts[2], parts[4])
+
+        else:
+            return None
+
+    def parse_key(self):
+        """
+        All include handlers parse paths the same way.
+        """
+        return IncludePageHandler
+
+
+class DependencyPageHandler(IncludePageHandler):
     """
     Load dependencies required by the test suite description.
     """
 
-    # Parse the suite name and relative path,
-    # ignoring any GET parameters in the URL.
-    PATH_REGEX = re.compile('^/suite/([^/]+)/include/([^?]+).*$')
+    # Files larger than this (in bytes) are streamed from disk
+    # on each request instead of being cached in memory.
+    MAX_CACHED_SIZE = 1024 * 1024
 
-    # MIME types (in addition to text/* that we serve as UTF-8 encoded)
-    TEXT_MIME_TYPES = [
-        'application/json',
-        'application/javascript',
-        'application/ecmascript',
-        'application/xml',
-    ]
+    # Maximum number of bytes to cache across all files.
+    # Once the cache is full, other files are read from disk
+    # on each request.
+    MAX_TOTAL_CACHED_SIZE = 64 * 1024 * 1024
 
     def __init__(self, desc_dict):
         """
@@ -469,6 +1006,21 @@ class DependencyPageHandler(BasePageHandler):
         super(DependencyPageHandler, self).__init__()
         self._desc_dict = desc_dict
 
+        # Map full file paths to `(mtime, size, contents)` tuples.
+        # A cached file is re-read if its modification time
+        # or size changes.
+        self._cache = {}
+
+        # Total size of the cached contents, and a lock
+        # so concurrent requests keep it accurate.
+        self._cached_size = 0
+        self._cache_lock = threading.Lock()
+
+        # Map suite names to dicts mapping each of their dependency
+        # paths to its full filesystem path.  Filled in the first
+        # time each suite is requested.
+        self._path_map_dict = {}
+
     def load_page(self, method, content, *args):
         """
         Load the test suite dependency file, using a path relative
@@ -477,7 +1029,7 @@ class DependencyPageHandler(BasePageHandler):
         Returns the handle to the dependency file.
         """
 
-        # Interpret the arguments (from the regex)
+        # Interpret the arguments (from the URL path)
         suite_name, rel_path = args
 
         # Retrieve the full path to the dependency, if it exists
@@ -485,15 +1037,7 @@ class DependencyPageHandler(BasePageHandler):
         full_path = self._dependency_path(suite_name, rel_path)
 
         if full_path is not None:
-
-            # Load the file
-            try:
-                return open(full_path, 'rb')
-
-            # If we cannot load the file (probably because it doesn't exist)
-            # then do not handle this request.
-            except IOError:
-                return None
+            return self._load_file(full_path)
 
         # If this is not one of our listed dependencies, 
         # then do not handle this request.
@@ -507,6 +1051,54 @@ class DependencyPageHandler(BasePageHandler):
         _, rel_path = args
         return self.guess_mime_type(rel_path)
 
+    def _load_file(self, full_path):
+        """
+        Return a file-like object with the contents of the file
+        at `full_path`, using the cached contents if the file
+        has not changed.  Returns None if the file cannot be loaded.
+        """
+
+        # Check the file's modification time and size,
+        # so we notice if it was edited since we cached it.
+        # If we cannot stat the file (probably because it doesn't exist)
+        # then do not handle this request.
+        try:
+            stat_result = os.stat(full_path)
+        except OSError:
+            return None
+
+        mtime, size = stat_result.st_mtime, stat_result.st_size
+
+        cached = self._cache.get(full_path)
+        if cached is not None and cached[:2] == (mtime, size):
+            return StringIO(cached[2])
+
+        # Load the file
+        try:
+            dep_file = open(full_path, 'rb')
+        except IOError:
+            return None
+
+        # Stream large files straight from disk
+        if size > self.MAX_CACHED_SIZE:
+            return dep_file
+
+        with dep_file:
+            contents = dep_file.read()
+
+        # Cache the contents if there's room, replacing
+        # any out-of-date contents for the same file
+        with self._cache_lock:
+            old_entry = self._cache.get(full_path)
+            old_size = len(old_entry[2]) if old_entry is not None else 0
+            new_total = self._cached_size - old_size + len(contents)
+
+            if new_total <= self.MAX_TOTAL_CACHED_SIZE:
+                self._cache[full_path] = (mtime, size, contents)
+                self._cached_size = new_total
+
+        return StringIO(contents)
+
     def _dependency_path(self, suite_name, path):
         """
         Return the full filesystem path to the dependency, if it
@@ -514,39 +1106,50 @@ class DependencyPageHandler(BasePageHandler):
         Otherwise, return None.
         """
 
-        # Try to find the suite description with `suite_name`
-        suite_desc = self._desc_dict.get(suite_name)
-
-        # If we can't find it, give up
-        if suite_desc is None:
-            return None
+        # Get the full paths of all dependencies in the suite
+        path_map = self._path_map_dict.get(suite_name)
 
-        # Get all dependency paths
-        all_paths = (suite_desc.lib_paths() +
-                     suite_desc.src_paths() +
-                     suite_desc.spec_paths() +
-                     suite_desc.fixture_paths())
+        if path_map is None:
 
-        # If the path is in our listed dependencies, we can serve it
-        if path in all_paths:
+            # Try to find the suite description with `suite_name`
+            suite_desc = self._desc_dict.get(suite_name)
 
-            # Resolve the full filesystem path
-            return os.path.join(suite_desc.root_dir(), path)
+            # If we can't find it, give up
+            if suite_desc is None:
+                return None
 
-        else:
+            # Resolve the full filesystem path of each dependency
+            root_dir = suite_desc.root_dir()
+            path_map = {
+                rel_path: os.path.join(root_dir, rel_path)
+                for rel_path in (suite_desc.lib_paths() +
+                                 suite_desc.src_paths() +
+                                 suite_desc.spec_paths() +
+                                 suite_desc.fixture_paths())
+            }
+            self._path_map_dict[suite_name] = path_map
 
-            # If we did not find the path, we cannot serve it
-            return None
+        # If the path is in our listed dependencies, we can serve it.
+        # Otherwise, return None.
+        return path_map.get(path)
 
 
-class InstrumentedSrcPageHandler(BasePageHandler):
+class InstrumentedSrcPageHandler(IncludePageHandler):
     """
     Instrument the JavaScript source file to collect coverage information.
     """
 
-    PATH_REGEX = re.compile('^/suite/([^/]+)/include/([^?]+).*$')
+    # Maximum time (in seconds) a request waits for JSCover
+    # to instrument a source.  If it takes longer, we serve
+    # the un-instrumented source instead.
+    INSTR_TIMEOUT = 30.0
 
-    def __init__(self, desc_dict, instr_dict):
+    # Maximum number of bytes of instrumented sources to cache.
+    # Once the cache is full, other sources are encoded
+    # on each request.
+    MAX_TOTAL_CACHED_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, desc_dict, instr_dict, instr_pool):
         """
         Initialize the dependency page handler to serve dependencies
         specified by `desc_dict` (a dict mapping suite names
@@ -555,22 +1158,68 @@ class InstrumentedSrcPageHandler(BasePageHandler):
         `instr_dict` is a dict mapping suite names to 
         `SrcInstrumenter` instances.  There should be one
         instrumenter for each suite.
+
+        `instr_pool` is the `WorkerPool` used to call
+        the instrumenters.
         """
         super(InstrumentedSrcPageHandler, self).__init__()
         self._desc_dict = desc_dict
         self._instr_dict = instr_dict
+        self._instr_pool = instr_pool
+
+        # Map suite names to frozensets of their source paths,
+        # filled in the first time each suite is requested.
+        self._src_set_dict = {}
+
+        # Map `(suite_name, rel_path)` tuples to
+        # `(mtime, size, encoded_src)` tuples, where `encoded_src`
+        # is the instrumented source encoded as UTF-8.
+        # The instrumenters cache the sources, but this saves
+        # encoding them each time.  A cached source is
+        # instrumented again if the source file's modification time
+        # or size changes.
+        self._encoded_src_dict = {}
+
+        # Total size of the cached sources, and a lock
+        # so concurrent requests keep it accurate.
+        self._cached_size = 0
+        self._cache_lock = threading.Lock()
 
     def load_page(self, method, content, *args):
         """
         Load an instrumented version of the JS source file.
         """
 
-        # Interpret the arguments (from the regex)
+        # Interpret the arguments (from the URL path)
         suite_name, rel_path = args
 
         # Check that this is a source file (not a lib or spec)
         if self._is_src_file(suite_name, rel_path):
 
+            # Check the source's modification time and size,
+            # so we notice if it was edited since we cached it.
+            # If we cannot stat the source, let JSCover decide
+            # whether it exists, but do not cache the result.
+            root_dir = self._desc_dict[suite_name].root_dir()
+            try:
+                stat_result = os.stat(os.path.join(root_dir, rel_path))
+            except OSError:
+                src_stat = None
+            else:
+                src_stat = (stat_result.st_mtime, stat_result.st_size)
+
+            # If we've already served this version of the source,
+            # serve it again.  If the source changed, ask the
+            # instrumenter to instrument it again.
+            cached = self._encoded_src_dict.get(args)
+            if cached is not None:
+                if src_stat is not None and cached[:2] == src_stat:
+                    return StringIO(cached[2])
+
+                instr = self._instr_dict.get(suite_name)
+                if instr is not None:
+                    instr.forget_src(rel_path)
+
             # Send the instrumented source (delegating to JSCover)
             contents = self._send_instrumented_src(suite_name, rel_path)
 
@@ -579,8 +1228,15 @@ class InstrumentedSrcPageHandler(BasePageHandler):
             # version of the source.
             if contents is None:
                 return None
+
             else:
-                return self.safe_str_buffer(contents)
+                if isinstance(contents, unicode):
+                    contents = contents.encode('utf-8')
+
+                if src_stat is not None:
+                    self._cache_src(args, src_stat, contents)
+
+                return StringIO(contents)
 
         # If not a source file, do not handle it.
         # Expect the non-instrumenting page handler to serve
@@ -595,6 +1251,35 @@ class InstrumentedSrcPageHandler(BasePageHandler):
         _, rel_path = args
         return self.guess_mime_type(rel_path)
 
+    def clear_cache(self):
+        """
+        Discard the cached instrumented sources.
+        """
+        with self._cache_lock:
+            self._encoded_src_dict = {}
+            self._cached_size = 0
+
+    def _cache_src(self, key, src_stat, contents):
+        """
+        Cache the encoded source `contents` for `key`
+        (a `(suite_name, rel_path)` tuple) if there's room,
+        replacing any out-of-date contents for the same source.
+        `src_stat` is the source file's `(mtime, size)` tuple.
+        """
+        with self._cache_lock:
+            old_entry = self._encoded_src_dict.get(key)
+            old_size = len(old_entry[2]) if old_entry is not None else 0
+            new_total = self._cached_size - old_size + len(contents)
+
+            if new_total <= self.MAX_TOTAL_CACHED_SIZE:
+                self._encoded_src_dict[key] = src_stat + (contents,)
+                self._cached_size = new_total
+
+            # If there isn't room, at least drop the out-of-date contents
+            elif old_entry is not None:
+                del self._encoded_src_dict[key]
+                self._cached_size -= old_size
+
     def _send_instrumented_src(self, suite_name, rel_path):
         """
         Return an instrumented version of the JS source file at `rel_path`
@@ -610,18 +1295,30 @@ class InstrumentedSrcPageHandler(BasePageHandler):
             LOGGER.warning(msg)
             return None
 
-        try:
+        # Call the instrumenter service on the server's pool of
+        # instrumenting threads, so we can stop waiting if it hangs.
+        task = self._instr_pool.submit(instr.instrumented_src, rel_path)
 
-            # This performs a synchronous call to the instrumenter
-            # service, raising an exception if it cannot retrieve
-            # the instrumented version of the source.
-            return instr.instrumented_src(rel_path)
-
-        # If we cannot get the instrumented source,
+        # If we cannot get the instrumented source in time,
         # return None.  This should cause the un-instrumented
         # version of the source to be served (when another
-        # handler matches the URL regex)
-        except SrcInstrumenterError as err:
+        # handler matches the URL regex).  If the instrumenter
+        # finishes later, it caches the source for next time.
+        if not task.wait(self.INSTR_TIMEOUT):
+            msg = "Timed out retrieving instrumented version of '{}'".format(rel_path)
+            LOGGER.warning(msg)
+            return None
+
+        try:
+
+            # This raises an exception if the instrumenter
+            # could not retrieve the instrumented version of the source.
+            return task.result()
+
+        # If we cannot get the instrumented source (or the server
+        # is stopping), return None so the un-instrumented
+        # source is served instead.
+        except (SrcInstrumenterError, WorkerPoolStoppedError) as err:
             msg = "Could not retrieve instrumented version of '{}': {}".format(rel_path, err)
             LOGGER.warning(msg)
             return None
@@ -637,7 +1334,13 @@ class InstrumentedSrcPageHandler(BasePageHandler):
         if suite_desc is None:
             return False
 
-        return (rel_path in suite_desc.src_paths())
+        src_paths = self._src_set_dict.get(suite_name)
+
+        if src_paths is None:
+            src_paths = frozenset(suite_desc.src_paths())
+            self._src_set_dict[suite_name] = src_paths
+
+        return (rel_path in src_paths)
 
 
 class StoreCoveragePageHandler(BasePageHandler):
@@ -647,11 +1350,12 @@ class StoreCoveragePageHandler(BasePageHandler):
     """
 
     PATH_REGEX = re.compile('^/jscoverage-store/([^/]+)/?$')
+    PATH_PREFIX = 'jscoverage-store'
 
     # Handle only POST
-    HTTP_METHODS = ["POST"]
+    HTTP_METHODS = frozenset(["POST"])
 
-    def __init__(self, desc_dict, coverage_data):
+    def __init__(self, desc_dict, coverage_data, coverage_cond, pending_suites):
         """
         Initialize the dependency page handler to serve dependencies
         specified by `desc_dict` (a dict mapping suite names to 
@@ -659,10 +1363,18 @@ class StoreCoveragePageHandler(BasePageHandler):
 
         `coverage_data` is the `CoverageData` instance to send
         any received coverage data to.
+
+        `coverage_cond` is a `threading.Condition` notified
+        after each coverage report is stored.
+
+        `pending_suites` is the set of suite names that have not
+        yet reported coverage; suites are removed as they report.
         """
         super(StoreCoveragePageHandler, self).__init__()
         self._desc_dict = desc_dict
         self._coverage_data = coverage_data
+        self._coverage_cond = coverage_cond
+        self._pending_suites = pending_suites
 
     def load_page(self, method, content, *args):
         """
@@ -673,7 +1385,26 @@ class StoreCoveragePageHandler(BasePageHandler):
         suite_name = args[0]
 
         # Store the coverage data
-        return self._store_coverage_data(suite_name, content)
+        result = self._store_coverage_data(suite_name, content)
+
+        # Mark the suite as reported.  The suite is recorded even
+        # if its data was invalid, so we do this either way.
+        # `set.discard()` is atomic, so this needs no lock.
+        # We do it after storing the data, so waiters never
+        # see a suite as reported before its data is loaded.
+        self._coverage_data.add_suite_name(suite_name)
+        self._pending_suites.discard(suite_name)
+
+        # Once every suite has reported, wake up anyone waiting
+        # for coverage data.  Waiters have nothing to do until then,
+        # so we don't wake them for the earlier reports.
+        # The condition is only used as a signal; the waiter re-checks
+        # the pending suites while holding it, so no wakeup is lost.
+        if not self._pending_suites:
+            with self._coverage_cond:
+                self._coverage_cond.notify_all()
+
+        return result
 
     def mime_type(self, method, content, *args):
         """
@@ -691,9 +1422,6 @@ class StoreCoveragePageHandler(BasePageHandler):
         Returns None if any errors occur; returns a success method if successful.
         """
 
-        # Record that we got a coverage report for this suite
-        self._coverage_data.add_suite_name(suite_name)
-
         # Retrieve the root directory for this suite
         suite_desc = self._desc_dict.get(suite_name)
 
@@ -730,40 +1458,32 @@ class SuitePageRequestHandler(BaseHTTPRequestHandler):
     Handle HTTP requsts to the `SuitePageServer`.
     """
 
-    protocol = "HTTP/1.0"
-
-    def __init__(self, request, client_address, server):
-
-        # Initialize the page handlers
-        # We always handle suite runner pages, and
-        # the runner dependencies (e.g. jasmine.js)
-        self._page_handlers = [SuitePageHandler(server.renderer, server.desc_dict),
-                               RunnerPageHandler()]
-
-        # If we are configured for coverage, add another handler
-        # to serve instrumented versions of the source files.
-        if len(server.src_instr_dict) > 0:
+    # Keep connections open between requests, so a suite page
+    # can load its dependencies without reconnecting each time.
+    # Every response we send includes a Content-Length header,
+    # which HTTP/1.1 clients need to reuse the connection.
+    # We still close the connection if the client asks us to
+    # (with a "Connection: close" header).
+    protocol_version = 'HTTP/1.1'
 
-            # Create the handler to serve instrumented JS pages
-            instr_src_handler = InstrumentedSrcPageHandler(server.desc_dict,
-                                                           server.src_instr_dict)
-            self._page_handlers.append(instr_src_handler)
+    # Close idle keep-alive connections after this many seconds,
+    # so clients that hold connections open don't tie up
+    # request threads indefinitely.
+    timeout = 5
 
-            # Create a handler to store coverage data POSTed back
-            # to the server from the client.
-            store_coverage_handler = StoreCoveragePageHandler(server.desc_dict,
-                                                              server.coverage_data)
-            self._page_handlers.append(store_coverage_handler)
+    # Buffer writes to the response, so the status line, headers,
+    # and small bodies go out in a single send instead of
+    # one system call per line.
+    wbufsize = -1
 
-        # We always serve dependencies.  If running with coverage,
-        # the instrumented src handler will intercept source files.
-        # Serving the un-instrumented version is the fallback, and
-        # will still be used for library/spec dependencies.
-        self._page_handlers.append(DependencyPageHandler(server.desc_dict))
+    # Maximum size of request content (e.g. coverage data) in bytes.
+    # Larger requests are refused without reading the content.
+    MAX_CONTENT_LENGTH = 64 * 1024 * 1024
 
-        # Call the superclass implementation
-        # This will immediately call do_GET() if the request is a GET
-        BaseHTTPRequestHandler.__init__(self, request, client_address, server)
+    # Number of bytes to read from the page content at a time
+    # when copying it to the response.  Each write goes straight
+    # to the socket, so larger chunks mean fewer system calls.
+    COPY_CHUNK_SIZE = 64 * 1024
 
     def finish(self):
         """
@@ -812,44 +1532,84 @@ class SuitePageRequestHandler(BaseHTTPRequestHandler):
         """
         Handle an HTTP request of type `method` (e.g. "GET" or "POST")
         """
-        # Get the request content
-        request_content = self._content()
+        # Get the request content.  Only POST requests
+        # (e.g. coverage reports) have content we use.
+        if method == "POST":
+            request_content = self._content()
 
-        for handler in self._page_handlers:
+        else:
+            request_content = ""
+
+            # We don't read content sent with other requests, so if
+            # there is any, we can't reuse the connection after this.
+            if self.headers.getheader('content-length', '0') != '0':
+                self.close_connection = 1
+
+        # If the request content is too large, refuse it without
+        # reading it.  Since the content is still waiting to be
+        # read, we can't reuse the connection.
+        if request_content is None:
+            self.close_connection = 1
+            self._send_response(413, None, 'text/plain')
+            return
+
+        # Only try the handlers for the first segment of the path
+        # (e.g. "suite" for "/suite/test-suite-0").
+        # The server creates the handlers once and shares them
+        # between requests.
+        path_parts = self.path.split('/', 2)
+        prefix = path_parts[1] if len(path_parts) > 1 else None
+
+        # Share parsed paths between handlers, so handlers that
+        # parse paths the same way (e.g. the instrumented and
+        # un-instrumented include handlers) parse the path once.
+        parsed_dict = {}
+
+        for handler in self.server.page_handler_dict.get(prefix, []):
 
             # Try to retrieve the page
             content, mime_type = handler.page_contents(
-                self.path, method, request_content
+                self.path, method, request_content, parsed_dict
             )
 
-            # If we got a page, send the contents
+            # If we got a page, send the contents.
+            # Large files are streamed from an open file,
+            # so close the content once we're done with it.
             if content is not None:
-
                 try:
-                    byte_range = self._requested_byte_range(self.headers, content)
-
-                # The requested range is not satisfiable; send a 406
-                except RequestRangeError:
-                    self._send_response(406, None, 'text/plain')
-                    return
-
-                # If no byte range requested, send all the content
-                if byte_range is None:
-                    self._send_response(200, content, mime_type)
-                    return
-
-                # If a byte range was requested, send partial content
-                else:
-                    self._send_response(
-                        206, content, mime_type,
-                        byte_range=byte_range
-                    )
-                    return
+                    self._send_content(content, mime_type)
+                finally:
+                    content.close()
+                return
 
         # If we could not retrieve the contents (e.g. because
         # the file does not exist), send an error response
         self._send_response(404, None, 'text/plain')
 
+    def _send_content(self, content, mime_type):
+        """
+        Send `content` (a file-like object) with the MIME type
+        `mime_type`, or just the byte range the client requested.
+        """
+        try:
+            byte_range = self._requested_byte_range(self.headers, content)
+
+        # The requested range is not satisfiable; send a 406
+        except RequestRangeError:
+            self._send_response(406, None, 'text/plain')
+            return
+
+        # If no byte range requested, send all the content
+        if byte_range is None:
+            self._send_response(200, content, mime_type)
+
+        # If a byte range was requested, send partial content
+        else:
+            self._send_response(
+                206, content, mime_type,
+                byte_range=byte_range
+            )
+
     def _requested_byte_range(self, headers, content_file):
         """
         Parse the requested byte range ('Range' header)
@@ -983,8 +1743,13 @@ class SuitePageRequestHandler(BaseHTTPRequestHandler):
 
         If content is None, send a response with no content.
         """
+        # Only text has a character set.  Other content
+        # (e.g. images) is sent as the raw bytes we loaded.
+        if mime_type.startswith('text/') or mime_type in BasePageHandler.TEXT_MIME_TYPES:
+            mime_type += '; charset=utf-8'
+
         self.send_response(status_code)
-        self.send_header('Content-Type', mime_type + '; charset=utf-8')
+        self.send_header('Content-Type', mime_type)
         self.send_header('Content-Language', 'en')
         self.send_header('Accept-Ranges', 'bytes')
 
@@ -1001,6 +1766,11 @@ class SuitePageRequestHandler(BaseHTTPRequestHandler):
             content_length = self._file_size(content) if content is not None else 0
             self.send_header('Content-Length', content_length)
 
+        # If the client asked us to close the connection,
+        # let it know we will (instead of keeping it alive)
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+
         self.end_headers()
 
         # Send the content
@@ -1011,24 +1781,52 @@ class SuitePageRequestHandler(BaseHTTPRequestHandler):
 
             # If no byte range specified, send the whole file
             if byte_range is None:
-                shutil.copyfileobj(content, self.wfile)
+                shutil.copyfileobj(content, self.wfile, self.COPY_CHUNK_SIZE)
 
             # Otherwise, send just the range requested
             else:
                 start_pos, end_pos = byte_range
-                copy_len = end_pos - start_pos
+                copy_len = end_pos - start_pos + 1
 
                 # Seek to the start of the file and send just the length requested
                 content.seek(start_pos)
-                shutil.copyfileobj(content, self.wfile, copy_len)
+                self._copy_bytes(content, copy_len)
+
+    def _copy_bytes(self, content, num_bytes):
+        """
+        Write at most `num_bytes` bytes from `content` (a file-like
+        object), starting at its current position, to the response.
+        """
+        while num_bytes > 0:
+            chunk = content.read(min(num_bytes, self.COPY_CHUNK_SIZE))
+
+            # Stop if we reached the end of the file early
+            if not chunk:
+                break
+
+            self.wfile.write(chunk)
+            num_bytes -= len(chunk)
 
     def _content(self):
         """
         Retrieve the content of the request.
+        Returns None if the content is longer than `MAX_CONTENT_LENGTH`.
         """
-        try:
-            length = int(self.headers.getheader('content-length'))
-        except (TypeError, ValueError):
+        length = self.headers.getheader('content-length', '').strip()
+
+        # If the length is missing or invalid, there's no content.
+        # This also rejects negative lengths, which would read
+        # until the client closes the connection.
+        if not length.isdigit():
             return ""
+
+        length = int(length)
+
+        if length == 0:
+            return ""
+
+        elif length > self.MAX_CONTENT_LENGTH:
+            return None
+
         else:
             return self.rfile.read(length)
@@ -2,6 +2,11 @@ import unittest
 import mock
 import requests
 import re
+import socket
+import threading
+import itertools
+import time
+from StringIO import StringIO
 from textwrap import dedent
 from js_test_tool.coverage import SrcInstrumenter, SrcInstrumenterError, CoverageData
 
@@ -10,7 +15,7 @@ class SrcInstrumenterTest(unittest.TestCase):
 
     TEST_ROOT_DIR = '/tmp/test'
     TEST_TOOL_PATH = '/usr/bin/jscover'
-    TEST_INSTRUMENTED_SRC = 'instrumented JS src'
+    TEST_INSTRUMENTED_SRC = u'instrumented JS src'
 
     ADDRESS_IN_USE_ERROR = dedent("""
         Exception in thread "main" java.lang.RuntimeException: java.net.BindException: Address already in use
@@ -39,13 +44,22 @@ class SrcInstrumenterTest(unittest.TestCase):
         # Configure the tool to return non-error
         self._configure_tool()
 
+        # Pretend that JSCover accepts connections as soon as it starts
+        patcher = mock.patch('js_test_tool.coverage.socket.create_connection')
+        self.create_connection = patcher.start()
+        self.addCleanup(patcher.stop)
+
         # Mock the requests module
+        # The instrumenter makes its HTTP calls through a session
         self.requests = mock.Mock()
+        self.session = self.requests.Session.return_value
 
         # Set wait between attempts to very short to speed up the tests
         # Since we are using mocks, this shouldn't be an issue
-        self._old_wait_between_attempts = SrcInstrumenter.WAIT_BETWEEN_ATTEMPTS
-        SrcInstrumenter.WAIT_BETWEEN_ATTEMPTS = 0.01
+        self._old_base_delay = SrcInstrumenter.BASE_DELAY
+        self._old_max_delay = SrcInstrumenter.MAX_DELAY
+        SrcInstrumenter.BASE_DELAY = 0.001
+        SrcInstrumenter.MAX_DELAY = 0.01
 
         # Create, but do not start, the service
         self.instrumenter = SrcInstrumenter(self.TEST_ROOT_DIR,
@@ -56,7 +70,8 @@ class SrcInstrumenterTest(unittest.TestCase):
     def tearDown(self):
 
         # Reset the old wait time between attempts
-        SrcInstrumenter.WAIT_BETWEEN_ATTEMPTS = self._old_wait_between_attempts
+        SrcInstrumenter.BASE_DELAY = self._old_base_delay
+        SrcInstrumenter.MAX_DELAY = self._old_max_delay
 
     def test_start_service(self):
 
@@ -73,6 +88,45 @@ class SrcInstrumenterTest(unittest.TestCase):
         # Expect that the service process was terminated
         self.process.terminate.assert_called_once_with()
 
+        # Expect that the connections to the service were closed
+        self.session.close.assert_called_once_with()
+
+        # Expect that the port can be used again
+        self.assertNotIn(self.instrumenter._port_num, SrcInstrumenter.used_ports)
+
+    def test_wait_until_listening(self):
+
+        # Refuse the first connection, then accept
+        self.create_connection.side_effect = [socket.error, mock.Mock()]
+
+        # Start the service
+        self.instrumenter.start()
+
+        # Expect that we waited for JSCover to accept a connection
+        self.assertEqual(self.create_connection.call_count, 2)
+        args, _ = self.create_connection.call_args
+        self.assertEqual(args[0][0], '127.0.0.1')
+
+        # Expect that JSCover was started only once
+        self._assert_jscover_called(self.TEST_TOOL_PATH,
+                                    self.TEST_ROOT_DIR)
+
+    def test_wait_until_listening_timeout(self):
+
+        # JSCover keeps running but never accepts a connection
+        self.create_connection.side_effect = socket.error
+        self.process.communicate.side_effect = None
+        self.process.communicate.return_value = ("", "")
+
+        # Expect an error once we run out of attempts
+        with mock.patch.object(SrcInstrumenter, 'STARTUP_TIMEOUT', 0.0):
+            with self.assertRaises(SrcInstrumenterError):
+                self.instrumenter.start()
+
+        # Expect that we stopped each JSCover process that did not start listening
+        self.assertEqual(self.process.terminate.call_count,
+                         SrcInstrumenter.MAX_START_ATTEMPTS)
+
     def test_get_instrumented_src(self):
 
         # Configure the `requests` HTTP library to return a
@@ -83,15 +137,19 @@ class SrcInstrumenterTest(unittest.TestCase):
         self.instrumenter.start()
         result = self.instrumenter.instrumented_src('src.js')
 
-        # Expect that the type we get back is unicode
+        # Expect that the type we get back is unicode,
+        # decoded as UTF-8
         self.assertTrue(isinstance(result, unicode))
+        self.assertEqual(self.session.get.return_value.encoding, 'utf-8')
 
         # Expect that we get the right source back
         self.assertEqual(result, self.TEST_INSTRUMENTED_SRC)
 
-        # Expect that a GET request was made at the correct URL
-        args, _ = self.requests.get.call_args
+        # Expect that a GET request was made at the correct URL,
+        # with a timeout in case JSCover hangs
+        args, kwargs = self.session.get.call_args
         self.assertEqual(len(args), 1)
+        self.assertEqual(kwargs, {'timeout': SrcInstrumenter.REQUEST_TIMEOUT})
 
         matches = re.match(r'http://127.0.0.1:\d+/src.js', args[0])
         self.assertIsNot(
@@ -99,6 +157,175 @@ class SrcInstrumenterTest(unittest.TestCase):
             msg="URL not in expected form: {}".format(args[0])
         )
 
+    def test_reuses_session(self):
+
+        # Configure the `requests` HTTP library to return a
+        # pre-defined response
+        self._configure_http_response(200, self.TEST_INSTRUMENTED_SRC)
+
+        # Instrument several sources
+        self.instrumenter.start()
+        self.instrumenter.instrumented_src('src.js')
+        self.instrumenter.instrumented_src('other.js')
+
+        # Expect that both requests used the same session
+        self.requests.Session.assert_called_once_with()
+        self.assertEqual(self.session.get.call_count, 2)
+
+        # Expect that we did NOT make requests outside the session
+        self.assertFalse(self.requests.get.called)
+
+    def test_caches_instrumented_src(self):
+
+        # Configure the `requests` HTTP library to return a
+        # pre-defined response
+        self._configure_http_response(200, self.TEST_INSTRUMENTED_SRC)
+
+        # Instrument the same source twice
+        self.instrumenter.start()
+        first = self.instrumenter.instrumented_src('src.js')
+        second = self.instrumenter.instrumented_src('src.js')
+
+        # Expect that we asked JSCover only once
+        self.assertEqual(first, self.TEST_INSTRUMENTED_SRC)
+        self.assertEqual(second, self.TEST_INSTRUMENTED_SRC)
+        self.assertEqual(self.session.get.call_count, 1)
+
+        # Restart the service, which should clear the cache
+        self.instrumenter.stop()
+        self.instrumenter.start()
+        self.instrumenter.instrumented_src('src.js')
+        self.assertEqual(self.session.get.call_count, 2)
+
+    def test_forget_src(self):
+
+        # Configure the `requests` HTTP library to return a
+        # pre-defined response
+        self._configure_http_response(200, self.TEST_INSTRUMENTED_SRC)
+
+        # Instrument a source, then forget it
+        self.instrumenter.start()
+        self.instrumenter.instrumented_src('src.js')
+        self.instrumenter.forget_src('src.js')
+
+        # Expect that we ask JSCover for the source again
+        self.instrumenter.instrumented_src('src.js')
+        self.assertEqual(self.session.get.call_count, 2)
+
+    def test_concurrent_requests_share_fetch(self):
+
+        # Configure the `requests` HTTP library to block
+        # until we tell it to respond
+        self._configure_http_response(200, self.TEST_INSTRUMENTED_SRC)
+        response = self.session.get.return_value
+        release = threading.Event()
+
+        def _get(*args, **kwargs):
+            release.wait()
+            return response
+
+        self.session.get.side_effect = _get
+
+        # Request the same source from several threads at once
+        self.instrumenter.start()
+        results = []
+
+        def _instrument():
+            results.append(self.instrumenter.instrumented_src('src.js'))
+
+        threads = [threading.Thread(target=_instrument) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+
+        # Let the request finish once the threads are waiting
+        time.sleep(0.1)
+        release.set()
+
+        for thread in threads:
+            thread.join()
+
+        # Expect that every thread got the source,
+        # but we asked JSCover only once
+        self.assertEqual(results, [self.TEST_INSTRUMENTED_SRC] * 4)
+        self.assertEqual(self.session.get.call_count, 1)
+
+    def test_concurrent_request_timeout(self):
+
+        # Configure the `requests` HTTP library to block
+        # until we tell it to respond
+        self._configure_http_response(200, self.TEST_INSTRUMENTED_SRC)
+        response = self.session.get.return_value
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def _get(*args, **kwargs):
+            release.wait(5)
+            return response
+
+        self.session.get.side_effect = _get
+
+        # Start a request for the source in another thread
+        self.instrumenter.start()
+        owner = threading.Thread(target=self.instrumenter.instrumented_src,
+                                 args=('src.js',))
+        owner.daemon = True
+        owner.start()
+
+        deadline = time.time() + 5
+        while self.session.get.call_count < 1 and time.time() < deadline:
+            time.sleep(0.01)
+
+        # Expect that a second request for the same source
+        # stops waiting for the first one, without asking JSCover again
+        with mock.patch.object(SrcInstrumenter, 'REQUEST_TIMEOUT', 0.01):
+            with self.assertRaises(SrcInstrumenterError):
+                self.instrumenter.instrumented_src('src.js')
+
+        self.assertEqual(self.session.get.call_count, 1)
+
+        release.set()
+        owner.join()
+
+    def test_instrumented_src_to_file(self):
+
+        # Configure the `requests` HTTP library to stream
+        # the response in chunks
+        self._configure_http_response(200, u'')
+        self.session.get.return_value.iter_content.return_value = ['instrumented ', 'src']
+
+        # Write the instrumented source to a file
+        self.instrumenter.start()
+        output = StringIO()
+        self.instrumenter.instrumented_src_to_file('src.js', output)
+
+        # Expect that we wrote every chunk, streaming the response
+        self.assertEqual(output.getvalue(), 'instrumented src')
+
+        # Expect that we closed the response
+        self.session.get.return_value.close.assert_called_once_with()
+
+        args, kwargs = self.session.get.call_args
+        self.assertEqual(kwargs, {'stream': True,
+                                  'timeout': SrcInstrumenter.REQUEST_TIMEOUT})
+        self.assertIsNot(
+            re.match(r'http://127.0.0.1:\d+/src.js', args[0]), None,
+            msg="URL not in expected form: {}".format(args[0])
+        )
+
+    def test_instrumented_src_to_file_error(self):
+
+        # Configure the `requests` HTTP library to return a
+        # 404 not found response
+        self._configure_http_response(404, u'')
+
+        # Expect an error
+        self.instrumenter.start()
+        with self.assertRaises(SrcInstrumenterError):
+            self.instrumenter.instrumented_src_to_file('src.js', StringIO())
+
+        # Expect that we still closed the response
+        self.session.get.return_value.close.assert_called_once_with()
+
     def test_instrumenter_returns_unicode(self):
 
         # Configure the `requests` HTTP library to return a
@@ -163,6 +390,75 @@ class SrcInstrumenterTest(unittest.TestCase):
                                     self.TEST_ROOT_DIR,
                                     num_calls=SrcInstrumenter.MAX_START_ATTEMPTS)
 
+    def test_skip_port_in_use(self):
+
+        # Find two ports in the range the instrumenter uses
+        # that are currently free.  (We avoid hard-coding a port,
+        # since another socket could happen to be using it.)
+        busy_port, free_port = itertools.islice(
+            (port for port in xrange(20000, 30000)
+             if SrcInstrumenter._port_is_free(port)),
+            2
+        )
+
+        # Occupy one of them, and make it the first one we try
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', busy_port))
+        sock.listen(1)
+
+        try:
+            with mock.patch.object(SrcInstrumenter, 'used_ports', set()):
+                with mock.patch('js_test_tool.coverage.random.randint') as randint:
+                    randint.side_effect = [busy_port, free_port]
+                    self.instrumenter.start()
+
+        finally:
+            sock.close()
+
+        # Expect that we started JSCover only once, on the open port
+        self._assert_jscover_called(self.TEST_TOOL_PATH,
+                                    self.TEST_ROOT_DIR,
+                                    num_calls=1)
+
+        args, _ = self.subprocess.Popen.call_args
+        self.assertIn('--port={}'.format(free_port), args[0])
+
+    def test_no_unused_port(self):
+
+        # Every port we try is already in use
+        with mock.patch.object(SrcInstrumenter, '_port_is_free', return_value=False):
+
+            # Expect an error instead of looping forever
+            with self.assertRaises(SrcInstrumenterError):
+                SrcInstrumenter._random_unused_port()
+
+    def test_port_released_on_failure(self):
+
+        # Configure the tool to always return an error
+        self._configure_tool(error_msg=self.ADDRESS_IN_USE_ERROR)
+
+        with mock.patch.object(SrcInstrumenter, 'used_ports', set()):
+
+            with self.assertRaises(SrcInstrumenterError):
+                self.instrumenter.start()
+
+            # Expect that we did not keep any of the ports
+            # JSCover could not start on
+            self.assertEqual(SrcInstrumenter.used_ports, set())
+
+    def test_port_released_on_command_not_found(self):
+
+        # Configure the tool to raise an OSError (tool path not found)
+        self.subprocess.Popen.side_effect = OSError
+
+        with mock.patch.object(SrcInstrumenter, 'used_ports', set()):
+
+            with self.assertRaises(SrcInstrumenterError):
+                self.instrumenter.start()
+
+            # Expect that we did not keep the port
+            self.assertEqual(SrcInstrumenter.used_ports, set())
+
     def test_command_not_found(self):
 
         # Configure the tool to raise an OSError (tool path not found)
@@ -192,8 +488,8 @@ class SrcInstrumenterTest(unittest.TestCase):
         # Raise a connection error on the first connection
         # Then return a success on the second attempt
         self._configure_http_response(200, self.TEST_INSTRUMENTED_SRC)
-        self.requests.get.side_effect = [requests.exceptions.ConnectionError,
-                                         self.requests.get.return_value]
+        self.session.get.side_effect = [requests.exceptions.ConnectionError,
+                                         self.session.get.return_value]
 
         # Get the instrumented source (expect a retry on the first failure)
         self.instrumenter.start()
@@ -205,12 +501,39 @@ class SrcInstrumenterTest(unittest.TestCase):
     def test_http_connection_refused_max_retry(self):
 
         # Raise a connection error on every attempt
-        self.requests.get.side_effect = requests.exceptions.ConnectionError
+        self.session.get.side_effect = requests.exceptions.ConnectionError
 
         # Expect that the instrumenter eventually gives up and raises an error
         with self.assertRaises(SrcInstrumenterError):
             self.instrumenter.instrumented_src('/src.js')
 
+    def test_http_timeout_max_retry(self):
+
+        # JSCover hangs, so every attempt times out
+        self.session.get.side_effect = requests.exceptions.ReadTimeout
+
+        # Expect that the instrumenter eventually gives up and raises an error
+        self.instrumenter.start()
+        with self.assertRaises(SrcInstrumenterError):
+            self.instrumenter.instrumented_src('/src.js')
+
+    def test_no_restart_after_stop(self):
+
+        self.instrumenter.start()
+
+        # Stop the service while a request is failing
+        def _get(*args, **kwargs):
+            self.instrumenter.stop()
+            raise requests.exceptions.ConnectionError()
+
+        self.session.get.side_effect = _get
+
+        # Expect that we give up instead of starting JSCover again
+        with self.assertRaises(SrcInstrumenterError):
+            self.instrumenter.instrumented_src('/src.js')
+
+        self.assertEqual(self.subprocess.Popen.call_count, 1)
+
     def test_error_when_not_started(self):
 
         # Set up a valid response, so we don't fail for other reasons
@@ -229,7 +552,7 @@ class SrcInstrumenterTest(unittest.TestCase):
         response_mock = mock.MagicMock(requests.models.Response)
         response_mock.status_code = status_code
         response_mock.text = content
-        self.requests.get.return_value = response_mock
+        self.session.get.return_value = response_mock
 
     def _configure_tool(self, error_msg=None, first_failure=False):
         """
@@ -9,6 +9,7 @@ from textwrap import dedent
 from lxml import etree
 
 from js_test_tool.tests.helpers import TempWorkspaceTestCase
+from js_test_tool import suite
 
 from js_test_tool.suite import SuiteDescription, SuiteDescriptionError, \
     SuiteRenderer, SuiteRendererError
@@ -111,6 +112,20 @@ class SuiteDescriptionTest(TempWorkspaceTestCase):
         self.assertEqual(desc.fixture_paths(), self.FIXTURE_FILES)
         self.assertEqual(desc.test_runner(), self.YAML_DATA['test_runner'])
 
+    def test_unnormalized_paths(self):
+
+        # Use paths with trailing slashes and "current directory" references
+        yaml_data = copy.deepcopy(self.YAML_DATA)
+        yaml_data['src_paths'] = ['./src/', 'other_src//', './single_file/src.js']
+
+        # Create the suite description using the YAML file,
+        # with a trailing slash on the root directory
+        yaml_file = self._yaml_buffer(yaml_data)
+        desc = SuiteDescription(yaml_file, self.temp_dir + '/')
+
+        # Expect that the relative paths are normalized
+        self.assertEqual(desc.src_paths(), self.SRC_FILES)
+
     def test_double_dot_paths(self):
 
         # Transform the paths into relative paths
@@ -262,6 +277,89 @@ class SuiteDescriptionTest(TempWorkspaceTestCase):
         self.assertEqual(desc.spec_paths(), self.SPEC_FILES)
         self.assertEqual(desc.fixture_paths(), self.FIXTURE_FILES)
 
+    def test_symlinks(self):
+
+        # Link to a file and to a directory from within the source dir
+        os.symlink(os.path.join(self.temp_dir, 'other_src/test.js'),
+                   os.path.join(self.temp_dir, 'src/link.js'))
+        os.symlink(os.path.join(self.temp_dir, 'other_src'),
+                   os.path.join(self.temp_dir, 'src/link_dir'))
+
+        # Create an in-memory YAML file from the data
+        yaml_file = self._yaml_buffer(self.YAML_DATA)
+
+        # Create the suite description using the YAML file
+        desc = SuiteDescription(yaml_file, self.temp_dir)
+
+        # Expect that we include the linked file,
+        # but do not descend into the linked directory
+        self.assertEqual(desc.src_paths(),
+                         ['src/1.js', 'src/2.js', 'src/link.js', 'src/subdir/3.js',
+                          'other_src/test.js', 'single_file/src.js'])
+
+    @unittest.skipIf(os.geteuid() == 0, "root can read any directory")
+    def test_unreadable_dir(self):
+
+        # Make a source subdirectory unreadable
+        subdir_path = os.path.join(self.temp_dir, 'src/subdir')
+        os.chmod(subdir_path, 0)
+        self.addCleanup(os.chmod, subdir_path, 0o755)
+
+        # Create the suite description using the YAML file
+        yaml_file = self._yaml_buffer(self.YAML_DATA)
+        desc = SuiteDescription(yaml_file, self.temp_dir)
+
+        # Expect that we skip the unreadable directory
+        self.assertEqual(desc.src_paths(),
+                         ['src/1.js', 'src/2.js',
+                          'other_src/test.js', 'single_file/src.js'])
+
+    def test_dir_listing_fails(self):
+
+        # Simulate an error listing a source subdirectory
+        # (for example, because it was deleted while we searched)
+        subdir_path = os.path.join(self.temp_dir, 'src/subdir')
+        real_scandir = suite.scandir
+
+        def _scandir(dir_path):
+            if dir_path == subdir_path:
+                raise OSError(13, 'Permission denied')
+            return real_scandir(dir_path)
+
+        # Create the suite description using the YAML file
+        yaml_file = self._yaml_buffer(self.YAML_DATA)
+
+        with mock.patch('js_test_tool.suite.scandir', side_effect=_scandir):
+            desc = SuiteDescription(yaml_file, self.temp_dir)
+            src_paths = desc.src_paths()
+
+        # Expect that we skip the directory we could not list
+        self.assertEqual(src_paths,
+                         ['src/1.js', 'src/2.js',
+                          'other_src/test.js', 'single_file/src.js'])
+
+    def test_paths_cached(self):
+
+        # Create the suite description using the YAML file
+        yaml_file = self._yaml_buffer(self.YAML_DATA)
+        desc = SuiteDescription(yaml_file, self.temp_dir)
+
+        # Watch for searches of the file system
+        with mock.patch.object(desc, '_file_paths', wraps=desc._file_paths) as file_paths:
+
+            # Paths were found when the description was loaded
+            self.assertEqual(desc.src_paths(), self.SRC_FILES)
+            self.assertEqual(file_paths.call_count, 0)
+
+            # Paths in the page are found only once
+            desc.src_paths(only_in_page=True)
+            desc.src_paths(only_in_page=True)
+            self.assertEqual(file_paths.call_count, 1)
+
+        # Modifying the result does not affect the cache
+        desc.src_paths().append('modified.js')
+        self.assertEqual(desc.src_paths(), self.SRC_FILES)
+
     def test_prepend_path(self):
 
         # Add a path to prepend to source paths in reports
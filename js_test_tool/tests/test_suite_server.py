@@ -8,12 +8,20 @@ import mock
 import re
 import requests
 import os
+import socket
+import httplib
+import threading
+import time
 import pkg_resources
 import json
+import mimetools
+from StringIO import StringIO
 from js_test_tool.suite import SuiteDescription, SuiteRenderer
 from js_test_tool.suite_server import SuitePageServer, SuitePageHandler, \
-    TimeoutError, DuplicateSuiteNameError
+    SuitePageRequestHandler, DependencyPageHandler, \
+    InstrumentedSrcPageHandler, TimeoutError, DuplicateSuiteNameError
 from js_test_tool.coverage import SrcInstrumenter, SrcInstrumenterError
+from js_test_tool.util import WorkerPool
 
 
 class SuitePageServerTest(TempWorkspaceTestCase):
@@ -82,6 +90,17 @@ class SuitePageServerTest(TempWorkspaceTestCase):
             expected_url = self.server.root_url() + u'suite/test-suite-{}'.format(suite_num)
             self.assertIn(expected_url, url_list)
 
+    def test_suite_url_list_unchanged_by_callers(self):
+
+        # The server builds the URL list once, so modifying the
+        # list we get back should not affect later calls
+        url_list = self.server.suite_url_list()
+        expected_list = list(url_list)
+        url_list.append(u'http://example.com/')
+        del url_list[0]
+
+        self.assertEqual(self.server.suite_url_list(), expected_list)
+
     def test_enforce_unique_suite_names(self):
 
         # Try to create a suite server in which two suites have the same name
@@ -95,10 +114,13 @@ class SuitePageServerTest(TempWorkspaceTestCase):
         suite_desc_list[2].suite_name.return_value = 'test-suite-1'
         suite_desc_list[3].suite_name.return_value = 'test-suite-3'
 
-        # Expect an error when initializing the server
-        with self.assertRaises(DuplicateSuiteNameError):
+        # Expect an error naming the duplicate when initializing the server
+        with self.assertRaises(DuplicateSuiteNameError) as context:
             SuitePageServer(suite_desc_list, self.suite_renderer)
 
+        self.assertEqual(str(context.exception),
+                         "Duplicate suite name(s): test-suite-1")
+
     def test_serve_suite_pages(self):
 
         # Configure the suite renderer to return a test string
@@ -121,6 +143,33 @@ class SuitePageServerTest(TempWorkspaceTestCase):
             url = url + "?param=12345"
             self._assert_page_equals(url, expected_page)
 
+    def test_serve_unicode_suite_pages(self):
+
+        # Configure the suite renderer to return non-ASCII characters
+        expected_page = u'\u0236est suite \u023Dock'
+        self.suite_renderer.render_to_string.return_value = expected_page
+
+        # Expect that the page is sent encoded as UTF-8
+        for url in self.server.suite_url_list():
+            self._assert_page_equals(url, expected_page)
+
+    def test_suite_pages_rendered_once(self):
+
+        # Configure the suite renderer to return a test string
+        expected_page = u'test suite mock'
+        self.suite_renderer.render_to_string.return_value = expected_page
+
+        # Load each page in the suite twice
+        url_list = self.server.suite_url_list()
+        for url in url_list + url_list:
+            self._assert_page_equals(url, expected_page)
+
+        # Expect that each page was rendered only once
+        self.assertEqual(
+            self.suite_renderer.render_to_string.call_count,
+            self.NUM_SUITE_DESC
+        )
+
     def test_serve_runners(self):
 
         for path in ['jasmine/jasmine.css',
@@ -133,6 +182,26 @@ class SuitePageServerTest(TempWorkspaceTestCase):
             url = self.server.root_url() + pkg_path
             self._assert_page_equals(url, expected_page)
 
+    def test_only_matching_handlers_consulted(self):
+
+        # Watch every handler that serves suite pages or dependencies
+        suite_handlers = self.server.page_handler_dict['suite']
+        for handler in suite_handlers:
+            patcher = mock.patch.object(
+                handler, 'page_contents', wraps=handler.page_contents
+            )
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        # Request a runner page
+        pkg_path = 'runner/jasmine/jasmine.js'
+        expected_page = pkg_resources.resource_string('js_test_tool', pkg_path)
+        self._assert_page_equals(self.server.root_url() + pkg_path, expected_page)
+
+        # Expect that the handlers for other paths were not asked for the page
+        for handler in suite_handlers:
+            self.assertFalse(handler.page_contents.called)
+
     def test_ignore_runner_get_params(self):
 
         for path in ['jasmine/jasmine.css',
@@ -230,6 +299,23 @@ class SuitePageServerTest(TempWorkspaceTestCase):
             url = self.server.root_url() + 'suite/test-suite-0/include/' + path
             self._assert_page_equals(url, file_contents, encoding=None)
 
+    def test_content_type_charset(self):
+
+        # Configure the suite description to contain a script and an image
+        self.suite_desc_list[0].lib_paths.return_value = ['lib.js']
+        self.suite_desc_list[0].fixture_paths.return_value = ['test.png']
+        self._create_fake_files(['lib.js', 'test.png'], u'test contents')
+
+        # Expect that only text content declares a character set
+        # (The exact script MIME type depends on the platform.)
+        url = self.server.root_url() + 'suite/test-suite-0/include/'
+
+        script_type = requests.get(url + 'lib.js').headers['Content-Type']
+        self.assertTrue(script_type.endswith('; charset=utf-8'), msg=script_type)
+
+        image_type = requests.get(url + 'test.png').headers['Content-Type']
+        self.assertEqual(image_type, 'image/png')
+
     def test_serve_byte_range_requests(self):
 
         # Configure the suite description to contain a binary fixture file
@@ -345,6 +431,41 @@ class SuitePageServerTest(TempWorkspaceTestCase):
         resp = requests.get(url, headers={'Range': 'bytes=10-2'})
         self.assertEqual(resp.status_code, 406)
 
+    def test_byte_range_sends_only_range(self):
+
+        # Configure the suite description to contain a binary fixture file
+        fixture_paths = ['fixtures/test.mp4']
+        self.suite_desc_list[0].fixture_paths.return_value = fixture_paths
+
+        # Create a fake file to serve, with distinct bytes
+        # so we can check which ones we received
+        os.mkdir('fixtures')
+        file_contents = ''.join(chr(num % 256) for num in range(10000))
+        self._create_fake_files(fixture_paths, file_contents, encoding=None)
+
+        # Send the request over a raw socket and read until the
+        # server closes the connection, so we see every byte sent
+        # (not just the bytes that match the Content-Length header).
+        sock = socket.create_connection(('127.0.0.1', self.port))
+        self.addCleanup(sock.close)
+        sock.sendall(
+            'GET /suite/test-suite-0/include/fixtures/test.mp4 HTTP/1.1\r\n'
+            'Host: 127.0.0.1\r\n'
+            'Range: bytes=100-199\r\n'
+            'Connection: close\r\n\r\n'
+        )
+
+        response = ''
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                break
+            response += data
+
+        # Expect that the body is exactly the range requested
+        _, body = response.split('\r\n\r\n', 1)
+        self.assertEqual(body, file_contents[100:200])
+
     def test_serve_iso_encoded_dependency(self):
 
         # Configure the suite description to contain dependency files
@@ -409,6 +530,134 @@ class SuitePageServerTest(TempWorkspaceTestCase):
             url = self.server.root_url() + 'suite/test-suite-0/include/' + path
             self._assert_page_equals(url, expected_page)
 
+    def test_keep_alive(self):
+
+        # Configure the suite renderer to return a test string
+        self.suite_renderer.render_to_string.return_value = u'test suite mock'
+
+        # Request a page, then the same page again on the same connection
+        conn = httplib.HTTPConnection('127.0.0.1', self.port)
+        self.addCleanup(conn.close)
+
+        for _ in range(2):
+            conn.request('GET', '/suite/test-suite-0')
+            response = conn.getresponse()
+
+            # Expect that the server keeps the connection open
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.read(), 'test suite mock')
+            self.assertFalse(response.will_close)
+
+    def test_stop_closes_idle_connections(self):
+
+        # Configure the suite renderer to return a test string
+        self.suite_renderer.render_to_string.return_value = u'test suite mock'
+
+        # Leave a keep-alive connection open after a request
+        conn = httplib.HTTPConnection('127.0.0.1', self.port)
+        self.addCleanup(conn.close)
+        conn.request('GET', '/suite/test-suite-0')
+        self.assertEqual(conn.getresponse().read(), 'test suite mock')
+
+        # Expect that the server stops without waiting
+        # for the connection to time out
+        start_time = time.time()
+        self.server.stop()
+        self.assertLess(time.time() - start_time, 1.0)
+
+        # Expect that the server closed the connection
+        self.assertEqual(conn.sock.recv(1), '')
+
+    def test_small_response_sent_at_once(self):
+
+        # Configure the suite renderer to return a test string
+        self.suite_renderer.render_to_string.return_value = u'test suite mock'
+
+        # Create a connection to the handler that records what it sends
+        server_sock, client_sock = socket.socketpair()
+        self.addCleanup(server_sock.close)
+        self.addCleanup(client_sock.close)
+        connection = self.RecordingSocket(server_sock)
+
+        # Handle a request for a suite page on the connection
+        client_sock.sendall(
+            'GET /suite/test-suite-0 HTTP/1.1\r\n'
+            'Host: localhost\r\n'
+            'Connection: close\r\n\r\n'
+        )
+        SuitePageRequestHandler(connection, ('127.0.0.1', 0), self.server)
+
+        # Expect that the status line, headers, and page
+        # were sent in a single write to the socket
+        self.assertEqual(len(connection.sent_list), 1)
+        self.assertTrue(connection.sent_list[0].startswith('HTTP/1.1 200'))
+        self.assertTrue(connection.sent_list[0].endswith('\r\n\r\ntest suite mock'))
+
+    class RecordingSocket(object):
+        """
+        Wrap a socket, recording each chunk of data sent on it.
+        """
+
+        def __init__(self, sock):
+            self._sock = sock
+            self.sent_list = []
+
+        def makefile(self, mode, bufsize):
+            return socket._fileobject(self, mode, bufsize)
+
+        def sendall(self, data):
+            if isinstance(data, memoryview):
+                data = data.tobytes()
+            self.sent_list.append(data)
+            self._sock.sendall(data)
+
+        def __getattr__(self, name):
+            return getattr(self._sock, name)
+
+    def test_close_connection_on_request(self):
+
+        # Configure the suite renderer to return a test string
+        self.suite_renderer.render_to_string.return_value = u'test suite mock'
+
+        # Ask the server to close the connection after the response
+        conn = httplib.HTTPConnection('127.0.0.1', self.port)
+        self.addCleanup(conn.close)
+        conn.request('GET', '/suite/test-suite-0',
+                     headers={'Connection': 'close'})
+        response = conn.getresponse()
+
+        # Expect that we get the page, and the server closes the connection
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.read(), 'test suite mock')
+        self.assertTrue(response.will_close)
+
+    def test_requests_handled_by_request_threads(self):
+
+        # Configure the suite renderer to return a test string
+        self.suite_renderer.render_to_string.return_value = u'test suite mock'
+
+        # Record the thread that handles each connection
+        thread_list = []
+        process_request_thread = self.server.process_request_thread
+
+        def _process(request, client_address):
+            thread_list.append(threading.current_thread())
+            process_request_thread(request, client_address)
+
+        self.server.process_request_thread = _process
+
+        # Request more pages (on separate connections) than
+        # there are request threads
+        num_requests = self.server.NUM_REQUEST_THREADS + 1
+        for _ in range(num_requests):
+            url = self.server.suite_url_list()[0]
+            self.assertEqual(requests.get(url).text, u'test suite mock')
+
+        # Expect that the request threads handled every connection
+        self.assertEqual(len(thread_list), num_requests)
+        for thread in thread_list:
+            self.assertIn(thread, self.server._request_threads)
+
     def test_404_pages(self):
 
         # Try a URL that is not one of the suite urls
@@ -425,6 +674,17 @@ class SuitePageServerTest(TempWorkspaceTestCase):
                              requests.codes.not_found,
                              msg=bad_url)
 
+    @mock.patch.object(SuitePageRequestHandler, 'MAX_CONTENT_LENGTH', 10)
+    def test_refuse_large_requests(self):
+
+        # POST more content than the server accepts
+        url = self.server.root_url() + 'jscoverage-store/test-suite-0'
+        response = requests.post(url, data='x' * 100)
+
+        # Expect that the server refuses the request
+        self.assertEqual(response.status_code,
+                         requests.codes.request_entity_too_large)
+
     def test_missing_dependency(self):
 
         # Configure the suite description to contain a file
@@ -435,6 +695,87 @@ class SuitePageServerTest(TempWorkspaceTestCase):
         response = requests.get(self.server.root_url() + 'not_found.txt')
         self.assertEqual(response.status_code, requests.codes.not_found)
 
+    @mock.patch('js_test_tool.suite_server.pkg_resources')
+    def test_runner_resources_cached(self, pkg_resources_mock):
+
+        # Configure the package resources to return a test string
+        pkg_resources_mock.resource_string.return_value = 'runner contents'
+
+        # Load the same runner page twice
+        url = self.server.root_url() + 'runner/jasmine/jasmine.js'
+        for _ in range(2):
+            self._assert_page_equals(url, u'runner contents')
+
+        # Expect that we loaded the resource only once
+        self.assertEqual(pkg_resources_mock.resource_string.call_count, 1)
+
+    def test_dependency_reloaded_when_changed(self):
+
+        # Configure the suite description to contain a spec file
+        self.suite_desc_list[0].spec_paths.return_value = ['spec.js']
+        self._create_fake_files(['spec.js'], u'old contents')
+
+        # Load the file, so the server caches it
+        url = self.server.root_url() + 'suite/test-suite-0/include/spec.js'
+        self._assert_page_equals(url, u'old contents')
+
+        # Change the file and push its modification time forward,
+        # in case the edit happened within the mtime resolution
+        self._create_fake_files(['spec.js'], u'new contents')
+        mtime = os.stat('spec.js').st_mtime + 10
+        os.utime('spec.js', (mtime, mtime))
+
+        # Expect that we get the updated file
+        self._assert_page_equals(url, u'new contents')
+
+    def test_dependency_cache_is_bounded(self):
+
+        # Configure the suite description to contain two spec files
+        self.suite_desc_list[0].spec_paths.return_value = ['spec1.js', 'spec2.js']
+        self._create_fake_files(['spec1.js', 'spec2.js'], u'spec contents')
+
+        # Limit the cache to one of the files
+        handler = self.server.page_handler_dict['suite'][-1]
+        self.assertIsInstance(handler, DependencyPageHandler)
+        handler.MAX_TOTAL_CACHED_SIZE = len('spec contents')
+
+        # Expect that we can load both files
+        url = self.server.root_url() + 'suite/test-suite-0/include/{}'
+        self._assert_page_equals(url.format('spec1.js'), u'spec contents')
+        self._assert_page_equals(url.format('spec2.js'), u'spec contents')
+
+        # Expect that only the first was cached
+        self.assertEqual(
+            handler._cache.keys(), [os.path.join(os.getcwd(), 'spec1.js')]
+        )
+
+    def test_large_dependency_streamed_and_closed(self):
+
+        # Configure the suite description to contain a spec file
+        self.suite_desc_list[0].spec_paths.return_value = ['spec.js']
+        self._create_fake_files(['spec.js'], u'large spec contents')
+
+        # Treat the file as too large to cache
+        handler = self.server.page_handler_dict['suite'][-1]
+        handler.MAX_CACHED_SIZE = 4
+
+        # Record the files the server opens
+        file_list = []
+
+        def _open(*args):
+            file_list.append(open(*args))
+            return file_list[-1]
+
+        with mock.patch('js_test_tool.suite_server.open', create=True, side_effect=_open):
+            url = self.server.root_url() + 'suite/test-suite-0/include/spec.js'
+            self._assert_page_equals(url, u'large spec contents')
+
+        # Expect that the file was streamed instead of cached,
+        # and closed once it was sent
+        self.assertEqual(handler._cache, {})
+        self.assertEqual(len(file_list), 1)
+        self.assertTrue(file_list[0].closed)
+
     def _assert_page_equals(self, url, expected_content, encoding='utf-8'):
         """
         Assert that the page at `url` contains `expected_content`.
@@ -555,6 +896,32 @@ class SuiteServerCoverageTest(TempWorkspaceTestCase):
         for instr in instr_mocks:
             instr.stop.assert_called_once_with()
 
+    @mock.patch('js_test_tool.suite_server.SrcInstrumenter')
+    def test_stops_instrumenters_if_one_fails_to_start(self, instrumenter_cls):
+
+        # Configure one instrumenter to fail to start
+        instr_mocks = [mock.MagicMock(SrcInstrumenter),
+                       mock.MagicMock(SrcInstrumenter)]
+        instr_mocks[1].start.side_effect = SrcInstrumenterError
+        instrumenter_cls.side_effect = instr_mocks
+
+        # Set up the descriptions
+        mock_desc_list = [self._mock_suite_desc('test-suite-0', '/root_1', ['src1.js']),
+                          self._mock_suite_desc('test-suite-1', '/root_2', ['src2.js'])]
+
+        server = SuitePageServer(mock_desc_list,
+                                 mock.MagicMock(SuiteRenderer),
+                                 jscover_path=self.JSCOVER_PATH)
+
+        # Expect that starting the server fails
+        with self.assertRaises(SrcInstrumenterError):
+            server.start()
+
+        # Expect that the instrumenter that did start was stopped,
+        # so its JSCover process isn't left running
+        instr_mocks[0].stop.assert_called_once_with()
+        self.assertFalse(instr_mocks[1].stop.called)
+
     @mock.patch('js_test_tool.suite_server.SrcInstrumenter')
     def test_serves_instrumented_source_files(self, instrumenter_cls):
 
@@ -584,6 +951,64 @@ class SuiteServerCoverageTest(TempWorkspaceTestCase):
 
         self.assertEqual(response.text, fake_src)
 
+    @mock.patch('js_test_tool.suite_server.SrcInstrumenter')
+    def test_stop_with_hung_instrumenter(self, instrumenter_cls):
+
+        # Configure the instrumenter class to return a mock
+        instr_mock = mock.MagicMock(SrcInstrumenter)
+        instrumenter_cls.return_value = instr_mock
+
+        # Configure the instrumenter to hang until it is stopped,
+        # like a call waiting on a hung JSCover
+        stopped = threading.Event()
+        self.addCleanup(stopped.set)
+
+        def _hang(rel_path):
+            stopped.wait(10)
+            raise SrcInstrumenterError("JSCover was stopped.")
+
+        instr_mock.instrumented_src.side_effect = _hang
+        instr_mock.stop.side_effect = stopped.set
+
+        # Create a mock description with one source file
+        mock_desc = self._mock_suite_desc('test-suite-0', '/root', ['src.js'])
+
+        # Create a suite page server for those descriptions
+        server = SuitePageServer([mock_desc],
+                                 mock.MagicMock(SuiteRenderer),
+                                 jscover_path=self.JSCOVER_PATH)
+
+        # Start the server
+        server.start()
+        self.addCleanup(server.stop)
+
+        # Request the source in the background, so that
+        # a request waits on the instrumenter too
+        url = server.root_url() + "suite/test-suite-0/include/src.js"
+
+        def _request():
+            try:
+                requests.get(url, timeout=5)
+            except requests.exceptions.RequestException:
+                pass
+
+        request_thread = threading.Thread(target=_request)
+        request_thread.daemon = True
+        request_thread.start()
+
+        # Wait for both the prefetch and the request to call the instrumenter
+        deadline = time.time() + 5
+        while instr_mock.instrumented_src.call_count < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(instr_mock.instrumented_src.call_count, 2)
+
+        # Expect that we can still stop the server
+        stop_thread = threading.Thread(target=server.stop)
+        stop_thread.daemon = True
+        stop_thread.start()
+        stop_thread.join(5)
+        self.assertFalse(stop_thread.is_alive())
+
     @mock.patch('js_test_tool.suite_server.SrcInstrumenter')
     def test_does_not_instrument_lib_or_spec_files(self, instrumenter_cls):
 
@@ -613,9 +1038,97 @@ class SuiteServerCoverageTest(TempWorkspaceTestCase):
         for url in url_list:
             requests.get(url, timeout=0.1)
 
-        # Ensure that the instrumenter was NOT invoked,
-        # since these are not source files
-        self.assertFalse(instr_mock.instrumented_src.called)
+        # Ensure that the instrumenter was NOT invoked for them,
+        # since these are not source files.
+        # (The source file may have been instrumented in the background.)
+        called_paths = [
+            args[0] for args, _ in instr_mock.instrumented_src.call_args_list
+        ]
+        self.assertNotIn('lib.js', called_paths)
+        self.assertNotIn('spec.js', called_paths)
+
+    @mock.patch('js_test_tool.suite_server.SrcInstrumenter')
+    def test_prefetches_instrumented_src(self, instrumenter_cls):
+
+        # Configure the instrumenter class to return a mock
+        instr_mock = mock.MagicMock(SrcInstrumenter)
+        instrumenter_cls.return_value = instr_mock
+
+        # Create the mock method before the background threads call it.
+        # Mocks create their attributes on first access, so threads
+        # accessing it at the same time could each get a different mock.
+        instr_mock.instrumented_src.return_value = u'instrumented'
+
+        # Create a mock description with several source files
+        src_paths = ['src{}.js'.format(num) for num in range(10)]
+        mock_desc = self._mock_suite_desc('test-suite-0', '/root', src_paths)
+
+        # Create a suite page server for the description
+        server = SuitePageServer([mock_desc],
+                                 mock.MagicMock(SuiteRenderer),
+                                 jscover_path=self.JSCOVER_PATH)
+
+        # Start the server, and wait for the background
+        # instrumentation to finish
+        server.start()
+        self.addCleanup(server.stop)
+
+        for task in server._prefetch_tasks:
+            task.wait(5)
+
+        # Expect that each source was instrumented without
+        # the browser asking for it
+        called_paths = [
+            args[0] for args, _ in instr_mock.instrumented_src.call_args_list
+        ]
+        self.assertEqual(sorted(called_paths), sorted(src_paths))
+
+    @mock.patch('js_test_tool.suite_server.SrcInstrumenter')
+    def test_prefetch_threads_bounded(self, instrumenter_cls):
+
+        # Configure the instrumenter class to return a mock
+        instr_mock = mock.MagicMock(SrcInstrumenter)
+        instrumenter_cls.return_value = instr_mock
+
+        # Keep track of how many sources we instrument at the same time
+        lock = threading.Lock()
+        running = [0]
+        max_running = [0]
+
+        def _count_running(rel_path):
+            with lock:
+                running[0] += 1
+                max_running[0] = max(max_running[0], running[0])
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+            return u'instrumented'
+
+        instr_mock.instrumented_src.side_effect = _count_running
+
+        # Create several suites, each with several source files
+        src_paths = ['src{}.js'.format(num) for num in range(10)]
+        mock_desc_list = [
+            self._mock_suite_desc('test-suite-{}'.format(num), '/root', src_paths)
+            for num in range(3)
+        ]
+
+        server = SuitePageServer(mock_desc_list,
+                                 mock.MagicMock(SuiteRenderer),
+                                 jscover_path=self.JSCOVER_PATH)
+
+        # Start the server, and wait for the background
+        # instrumentation to finish
+        server.start()
+        self.addCleanup(server.stop)
+
+        for task in server._prefetch_tasks:
+            task.wait(5)
+
+        # Expect that every source was instrumented, but the suites
+        # shared a limited number of threads
+        self.assertEqual(instr_mock.instrumented_src.call_count, 30)
+        self.assertLessEqual(max_running[0], SuitePageServer.NUM_PREFETCH_THREADS)
 
     @mock.patch('js_test_tool.suite_server.SrcInstrumenter')
     def test_instrumenter_fails_gracefully(self, instrumenter_cls):
@@ -681,6 +1194,9 @@ class SuiteServerCoverageTest(TempWorkspaceTestCase):
         self.assertEqual(result_data.line_dict_for_src('/root/src.js'),
                          {0: True, 1: False, 3: True, 4: True, 6: False})
 
+        # Expect that the coverage data records which suite reported
+        self.assertEqual(result_data.suite_name_list(), ['test-suite-0'])
+
     def test_uncovered_src(self):
 
         # Create the source file -- we need to do this
@@ -743,6 +1259,54 @@ class SuiteServerCoverageTest(TempWorkspaceTestCase):
         with self.assertRaises(TimeoutError):
             server.all_coverage_data()
 
+    @mock.patch('js_test_tool.suite_server.SrcInstrumenter')
+    def test_timeout_is_prompt(self, instrumenter_cls):
+
+        # Start the page server, but never report coverage
+        server = SuitePageServer([self._mock_suite_desc('test-suite-0', '/root', ['src.js'])],
+                                 mock.MagicMock(SuiteRenderer),
+                                 jscover_path=self.JSCOVER_PATH)
+        server.start()
+        self.addCleanup(server.stop)
+
+        # Expect that we time out close to the configured timeout
+        start_time = time.time()
+        with self.assertRaises(TimeoutError):
+            server.all_coverage_data()
+        elapsed = time.time() - start_time
+
+        self.assertGreaterEqual(elapsed, SuitePageServer.COVERAGE_TIMEOUT)
+        self.assertLess(elapsed, SuitePageServer.COVERAGE_TIMEOUT + 0.5)
+
+    @mock.patch('js_test_tool.suite_server.SrcInstrumenter')
+    def test_returns_when_last_coverage_arrives(self, instrumenter_cls):
+
+        # Use a long timeout, so we can tell whether we waited for it
+        SuitePageServer.COVERAGE_TIMEOUT = 10.0
+
+        # Start the page server
+        server = SuitePageServer([self._mock_suite_desc('test-suite-0', '/root', ['src.js'])],
+                                 mock.MagicMock(SuiteRenderer),
+                                 jscover_path=self.JSCOVER_PATH)
+        server.start()
+        self.addCleanup(server.stop)
+
+        # POST the coverage data shortly after we start waiting for it
+        def _post_coverage():
+            time.sleep(0.1)
+            requests.post(server.root_url() + "jscoverage-store/test-suite-0",
+                          data=json.dumps({}), timeout=1.0)
+
+        post_thread = threading.Thread(target=_post_coverage)
+        post_thread.start()
+        self.addCleanup(post_thread.join)
+
+        # Expect that we get the data as soon as it arrives,
+        # well before the timeout
+        start_time = time.time()
+        self.assertIsNot(server.all_coverage_data(), None)
+        self.assertLess(time.time() - start_time, 2.0)
+
     @staticmethod
     def _mock_suite_desc(suite_name, root_dir, src_paths,
                          lib_paths=None, spec_paths=None):
@@ -797,3 +1361,314 @@ class SuitePageHandlerTest(unittest.TestCase):
 
             except UnicodeEncodeError:
                 self.fail("Could not encode {}".format(repr(str_input)))
+
+    def test_guess_mime_type(self):
+
+        # Guess the types of some files, and of a file
+        # with a type we don't recognize
+        self.assertEqual(SuitePageHandler.guess_mime_type('img/test.png'), 'image/png')
+        self.assertEqual(SuitePageHandler.guess_mime_type('img/TEST.PNG'), 'image/png')
+        self.assertEqual(SuitePageHandler.guess_mime_type('test.unknown'), 'text/plain')
+        self.assertEqual(SuitePageHandler.guess_mime_type('no_extension'), 'text/plain')
+
+        # Expect that we guess from every extension of the name,
+        # not just the last one
+        self.assertEqual(SuitePageHandler.guess_mime_type('a.tar.gz'), 'application/x-tar')
+        self.assertTrue(SuitePageHandler.guess_mime_type('b.js.gz').endswith('javascript'))
+
+        # Expect that later guesses for the same extensions
+        # don't need to look up the type again
+        with mock.patch('mimetypes.guess_type') as guess_type:
+            self.assertEqual(SuitePageHandler.guess_mime_type('other.png'), 'image/png')
+            self.assertEqual(SuitePageHandler.guess_mime_type('other.unknown'), 'text/plain')
+            self.assertFalse(guess_type.called)
+
+    def test_parse_path(self):
+
+        handler = SuitePageHandler(mock.MagicMock(SuiteRenderer), {})
+
+        test_cases = [
+            ('/suite/test-suite', ('test-suite',)),
+            ('/suite/test-suite/', ('test-suite',)),
+            ('/suite/test-suite?123456', ('test-suite',)),
+            ('/suite/test-suite/?a=/b', ('test-suite',)),
+            ('/suite/', None),
+            ('/suite//', None),
+            ('/suite/test-suite//', None),
+            ('/suite/test-suite/include/src.js', None),
+            ('/runner/test-suite', None),
+        ]
+
+        for path, expected in test_cases:
+            self.assertEqual(handler.parse_path(path), expected, msg=path)
+
+    def test_concurrent_requests_render_once(self):
+
+        # Configure a renderer that takes a while to render
+        renderer = mock.MagicMock(SuiteRenderer)
+
+        def _render(*args):
+            time.sleep(0.05)
+            return u'test suite mock'
+
+        renderer.render_to_string.side_effect = _render
+
+        handler = SuitePageHandler(
+            renderer, {'test-suite': mock.MagicMock(SuiteDescription)}
+        )
+
+        # Load the page from several threads at once
+        page_list = []
+
+        def _load_page():
+            page = handler.load_page('GET', '', 'test-suite')
+            page_list.append(page.getvalue())
+
+        thread_list = [threading.Thread(target=_load_page) for _ in range(4)]
+        for thread in thread_list:
+            thread.start()
+        for thread in thread_list:
+            thread.join()
+
+        # Expect that every thread got the page,
+        # but the page was rendered only once
+        self.assertEqual(page_list, ['test suite mock'] * 4)
+        self.assertEqual(renderer.render_to_string.call_count, 1)
+
+
+class SuitePageRequestHandlerTest(unittest.TestCase):
+    """
+    Tests for reading request content in `SuitePageRequestHandler`.
+    """
+
+    def test_content(self):
+
+        # Map Content-Length header values to the content we expect
+        expected_dict = {
+            None: '',
+            '': '',
+            'abc': '',
+            '-1': '',
+            '0': '',
+            '4': 'test',
+            ' 4 ': 'test',
+        }
+
+        for length, expected_content in expected_dict.items():
+
+            header_str = '' if length is None else 'Content-Length: {}\n'.format(length)
+            handler = self.FakeRequestHandler(header_str, 'test content')
+            self.assertEqual(handler._content(), expected_content, msg=length)
+
+    class FakeRequestHandler(SuitePageRequestHandler):
+        """
+        Request handler with the given headers and content,
+        which does not handle a request when created.
+        """
+
+        def __init__(self, header_str, content):
+            self.headers = mimetools.Message(StringIO(header_str))
+            self.rfile = StringIO(content)
+
+
+class IncludePageHandlerTest(unittest.TestCase):
+    """
+    Tests for parsing include paths in `IncludePageHandler`.
+    """
+
+    def test_parse_path(self):
+
+        handler = DependencyPageHandler({})
+
+        test_cases = [
+            ('/suite/test-suite/include/src.js', ('test-suite', 'src.js')),
+            ('/suite/test-suite/include/sub/dir/src.js', ('test-suite', 'sub/dir/src.js')),
+            ('/suite/test-suite/include/src.js?123456', ('test-suite', 'src.js')),
+            ('/suite/test-suite/include/src.js?a=/b', ('test-suite', 'src.js')),
+            ('/suite/test-suite/include/', None),
+            ('/suite//include/src.js', None),
+            ('/suite/test-suite/src.js', None),
+            ('/suite/test-suite', None),
+            ('/runner/test-suite/include/src.js', None),
+        ]
+
+        for path, expected in test_cases:
+            self.assertEqual(handler.parse_path(path), expected, msg=path)
+
+    def test_handlers_share_parsed_path(self):
+
+        # Create two include handlers with no dependencies to serve
+        handlers = [DependencyPageHandler({}), DependencyPageHandler({})]
+
+        with mock.patch.object(DependencyPageHandler, 'parse_path',
+                               return_value=('test-suite', 'src.js')) as parse_path:
+
+            # Try each handler on the same request
+            parsed_dict = {}
+            for handler in handlers:
+                handler.page_contents('/suite/test-suite/include/src.js',
+                                      'GET', '', parsed_dict)
+
+        # Expect that we parsed the path only once
+        self.assertEqual(parse_path.call_count, 1)
+
+    def test_no_mime_type_for_missing_page(self):
+
+        # Create an include handler with no dependencies to serve
+        handler = DependencyPageHandler({})
+
+        with mock.patch.object(DependencyPageHandler, 'mime_type') as mime_type:
+            result = handler.page_contents('/suite/test-suite/include/src.js', 'GET', '')
+
+        # Expect that we didn't load the page, so we
+        # didn't need to guess its MIME type
+        self.assertEqual(result, (None, None))
+        self.assertFalse(mime_type.called)
+
+
+class InstrumentedSrcPageHandlerTest(TempWorkspaceTestCase):
+    """
+    Tests for serving instrumented sources in `InstrumentedSrcPageHandler`.
+    """
+
+    def setUp(self):
+
+        # Create the temp workspace
+        super(InstrumentedSrcPageHandlerTest, self).setUp()
+
+        # Create a pool of threads to call the instrumenter
+        self.instr_pool = WorkerPool(2)
+        self.instr_pool.start()
+        self.addCleanup(self.instr_pool.stop)
+
+        # Create a suite with one source file
+        with open('src.js', 'w') as src_file:
+            src_file.write('src')
+
+        self.suite_desc = mock.MagicMock(SuiteDescription)
+        self.suite_desc.root_dir.return_value = self.temp_dir
+        self.suite_desc.src_paths.return_value = ['src.js']
+
+    def test_encoded_src_cached(self):
+
+        instr = mock.MagicMock(SrcInstrumenter)
+        instr.instrumented_src.return_value = u'instr\u1205ented src'
+
+        handler = InstrumentedSrcPageHandler(
+            {'test-suite': self.suite_desc}, {'test-suite': instr}, self.instr_pool
+        )
+
+        # Load the source twice
+        for _ in range(2):
+            page = handler.load_page('GET', '', 'test-suite', 'src.js')
+            self.assertEqual(page.getvalue(), u'instr\u1205ented src'.encode('utf-8'))
+
+        # Expect that we asked the instrumenter only once
+        instr.instrumented_src.assert_called_once_with('src.js')
+
+    def test_changed_src_instrumented_again(self):
+
+        instr = mock.MagicMock(SrcInstrumenter)
+        instr.instrumented_src.side_effect = [u'old src', u'new src']
+
+        handler = InstrumentedSrcPageHandler(
+            {'test-suite': self.suite_desc}, {'test-suite': instr}, self.instr_pool
+        )
+
+        page = handler.load_page('GET', '', 'test-suite', 'src.js')
+        self.assertEqual(page.getvalue(), 'old src')
+
+        # Change the source (its size, in case the modification
+        # time has the same value)
+        with open('src.js', 'w') as src_file:
+            src_file.write('changed src')
+
+        # Expect that the instrumenter forgets the old version,
+        # and we serve the new version
+        page = handler.load_page('GET', '', 'test-suite', 'src.js')
+        self.assertEqual(page.getvalue(), 'new src')
+        instr.forget_src.assert_called_once_with('src.js')
+
+    def test_cache_size_limit(self):
+
+        instr = mock.MagicMock(SrcInstrumenter)
+        instr.instrumented_src.return_value = u'instrumented src'
+
+        handler = InstrumentedSrcPageHandler(
+            {'test-suite': self.suite_desc}, {'test-suite': instr}, self.instr_pool
+        )
+        handler.MAX_TOTAL_CACHED_SIZE = 4
+
+        # Load the source twice
+        for _ in range(2):
+            page = handler.load_page('GET', '', 'test-suite', 'src.js')
+            self.assertEqual(page.getvalue(), 'instrumented src')
+
+        # Expect that the source did not fit in the cache,
+        # so we asked the instrumenter each time
+        self.assertEqual(instr.instrumented_src.call_count, 2)
+
+    def test_clear_cache(self):
+
+        instr = mock.MagicMock(SrcInstrumenter)
+        instr.instrumented_src.return_value = u'instrumented src'
+
+        handler = InstrumentedSrcPageHandler(
+            {'test-suite': self.suite_desc}, {'test-suite': instr}, self.instr_pool
+        )
+
+        # Load the source, then clear the cache (as the server does when it stops)
+        handler.load_page('GET', '', 'test-suite', 'src.js')
+        handler.clear_cache()
+
+        # Expect that we ask the instrumenter again
+        handler.load_page('GET', '', 'test-suite', 'src.js')
+        self.assertEqual(instr.instrumented_src.call_count, 2)
+
+    def test_instrumenter_timeout(self):
+
+        # Configure the instrumenter to hang until we release it
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        instr = mock.MagicMock(SrcInstrumenter)
+        instr.instrumented_src.side_effect = lambda rel_path: release.wait(5)
+
+        handler = InstrumentedSrcPageHandler(
+            {'test-suite': self.suite_desc}, {'test-suite': instr}, self.instr_pool
+        )
+        handler.INSTR_TIMEOUT = 0.1
+
+        # Expect that we give up on the instrumenter, so the
+        # un-instrumented source can be served instead
+        start_time = time.time()
+        self.assertIs(handler.load_page('GET', '', 'test-suite', 'src.js'), None)
+        self.assertLess(time.time() - start_time, 1.0)
+
+    def test_instrumenter_error(self):
+
+        # Configure the instrumenter to fail
+        instr = mock.MagicMock(SrcInstrumenter)
+        instr.instrumented_src.side_effect = SrcInstrumenterError
+
+        handler = InstrumentedSrcPageHandler(
+            {'test-suite': self.suite_desc}, {'test-suite': instr}, self.instr_pool
+        )
+
+        # Expect that we don't serve the source, so the
+        # un-instrumented source can be served instead
+        self.assertIs(handler.load_page('GET', '', 'test-suite', 'src.js'), None)
+
+    def test_stopped_pool(self):
+
+        instr = mock.MagicMock(SrcInstrumenter)
+
+        handler = InstrumentedSrcPageHandler(
+            {'test-suite': self.suite_desc}, {'test-suite': instr}, self.instr_pool
+        )
+
+        # Once the server stops its pool, expect that we don't
+        # call the instrumenter (which may have stopped too)
+        self.instr_pool.stop()
+        self.assertIs(handler.load_page('GET', '', 'test-suite', 'src.js'), None)
+        self.assertFalse(instr.instrumented_src.called)
@@ -0,0 +1,234 @@
+import unittest
+import mock
+import threading
+import time
+from js_test_tool.util import retry, map_in_threads, \
+    WorkerPool, WorkerPoolStoppedError
+
+
+class RetryTest(unittest.TestCase):
+
+    def setUp(self):
+
+        # Create a function that always fails
+        self.try_func = mock.Mock(side_effect=ValueError)
+
+    @mock.patch('js_test_tool.util.time.sleep')
+    def test_fixed_wait(self, mock_sleep):
+
+        # By default, wait the same amount of time between each attempt
+        with self.assertRaises(ValueError):
+            retry(self.try_func, 4, 0.5)
+
+        self.assertEqual(self.try_func.call_count, 4)
+        self.assertEqual(mock_sleep.call_args_list,
+                         [mock.call(0.5)] * 3)
+
+    @mock.patch('js_test_tool.util.time.sleep')
+    def test_exponential_backoff(self, mock_sleep):
+
+        # Double the wait after each failed attempt, up to a maximum
+        with self.assertRaises(ValueError):
+            retry(self.try_func, 5, 0.1, backoff=2, max_wait_sec=1.0)
+
+        waits = [args[0] for args, _ in mock_sleep.call_args_list]
+        self.assertEqual(len(waits), 4)
+        for actual, expected in zip(waits, [0.2, 0.4, 0.8, 1.0]):
+            self.assertAlmostEqual(actual, expected)
+
+    @mock.patch('js_test_tool.util.random.random')
+    @mock.patch('js_test_tool.util.time.sleep')
+    def test_jitter(self, mock_sleep, mock_random):
+
+        # Stretch each wait by a random fraction of the jitter
+        mock_random.return_value = 0.5
+
+        with self.assertRaises(ValueError):
+            retry(self.try_func, 2, 0.1, jitter=0.5)
+
+        args, _ = mock_sleep.call_args
+        self.assertAlmostEqual(args[0], 0.125)
+
+    @mock.patch('js_test_tool.util.time.sleep')
+    def test_succeed_after_retry(self, mock_sleep):
+
+        # Fail once, then succeed
+        self.try_func.side_effect = [ValueError, 'success']
+
+        self.assertEqual(retry(self.try_func, 3, 0.1), 'success')
+        self.assertEqual(mock_sleep.call_count, 1)
+
+
+class MapInThreadsTest(unittest.TestCase):
+
+    def test_results_in_order(self):
+
+        # Expect the results in the same order as the inputs
+        self.assertEqual(map_in_threads(lambda num: num * 2, [1, 2, 3, 4]),
+                         [2, 4, 6, 8])
+
+    def test_runs_concurrently(self):
+
+        # Each call waits until every call has started,
+        # which can only happen if they run at the same time
+        num_items = 4
+        started = []
+        all_started = threading.Event()
+
+        def _wait_for_others(num):
+            started.append(num)
+            if len(started) == num_items:
+                all_started.set()
+            return all_started.wait(5)
+
+        self.assertEqual(map_in_threads(_wait_for_others, range(num_items)),
+                         [True] * num_items)
+
+    def test_reraises_error(self):
+
+        def _fail_on_two(num):
+            if num == 2:
+                raise ValueError(num)
+            return num
+
+        # Expect that the error is raised after all calls finish
+        with self.assertRaises(ValueError):
+            map_in_threads(_fail_on_two, [1, 2, 3])
+
+    def test_reraises_earliest_error(self):
+
+        def _fail_slowly_on_one(num):
+
+            # The error for the first item finishes last
+            if num == 1:
+                time.sleep(0.1)
+            raise ValueError(num)
+
+        # Expect the error for the first item, no matter
+        # which call failed first
+        with self.assertRaises(ValueError) as context:
+            map_in_threads(_fail_slowly_on_one, [1, 2, 3])
+
+        self.assertEqual(context.exception.args, (1,))
+
+    def test_max_workers(self):
+
+        # Keep track of how many calls run at the same time
+        lock = threading.Lock()
+        running = [0]
+        max_running = [0]
+
+        def _count_running(num):
+            with lock:
+                running[0] += 1
+                max_running[0] = max(max_running[0], running[0])
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+            return num
+
+        # Expect that we call each item, in at most two threads
+        self.assertEqual(map_in_threads(_count_running, range(8), max_workers=2),
+                         range(8))
+        self.assertLessEqual(max_running[0], 2)
+
+    def test_empty_list(self):
+        self.assertEqual(map_in_threads(lambda num: num, []), [])
+
+
+class WorkerPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = WorkerPool(2)
+        self.pool.start()
+        self.addCleanup(self.pool.stop)
+
+    def test_result(self):
+        task = self.pool.submit(lambda num: num * 2, 4)
+        self.assertTrue(task.wait(5))
+        self.assertEqual(task.result(), 8)
+
+    def test_reraises_error(self):
+
+        def _fail():
+            raise ValueError()
+
+        task = self.pool.submit(_fail)
+        self.assertTrue(task.wait(5))
+
+        with self.assertRaises(ValueError):
+            task.result()
+
+    def test_limits_threads(self):
+
+        # Block the pool's threads until we release them
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        running = []
+
+        def _block(num):
+            running.append(num)
+            release.wait(5)
+            return num
+
+        task_list = [self.pool.submit(_block, num) for num in range(4)]
+
+        # Expect that only two tasks start, since the pool has two threads
+        self.assertTrue(task_list[0].wait(0.1) is False)
+        self.assertEqual(len(running), 2)
+
+        # Once released, expect every task to finish
+        release.set()
+        self.assertEqual([task.wait(5) for task in task_list], [True] * 4)
+        self.assertEqual([task.result() for task in task_list], range(4))
+
+    def test_stop(self):
+
+        # Start a task that blocks until we release it,
+        # and queue another task behind each thread
+        release = threading.Event()
+        started = threading.Event()
+        self.addCleanup(release.set)
+
+        def _block():
+            started.set()
+            release.wait(5)
+            return 'done'
+
+        running_task = self.pool.submit(_block)
+        self.assertTrue(started.wait(5))
+
+        other_task = self.pool.submit(_block)
+        queued_task = self.pool.submit(_block)
+
+        # Stop the pool while the tasks are running
+        # (Wait until the pool is stopping before releasing the tasks.)
+        stop_thread = threading.Thread(target=self.pool.stop)
+        stop_thread.start()
+
+        for _ in range(500):
+            if self.pool._is_stopped:
+                break
+            time.sleep(0.01)
+
+        release.set()
+        stop_thread.join(5)
+        self.assertFalse(stop_thread.is_alive())
+
+        # Expect that the running task finished
+        self.assertEqual(running_task.result(), 'done')
+
+        # Expect that tasks either finished or were cancelled,
+        # and that at least the last queued task did not run
+        for task in [other_task, queued_task]:
+            self.assertTrue(task.wait(0))
+
+        with self.assertRaises(WorkerPoolStoppedError):
+            queued_task.result()
+
+        # Expect that tasks submitted after stopping don't run
+        task = self.pool.submit(_block)
+        self.assertTrue(task.wait(0))
+        with self.assertRaises(WorkerPoolStoppedError):
+            task.result()
@@ -2,7 +2,11 @@
 Utility functions.
 """
 import time
+import random
 import logging
+import threading
+import Queue
+import sys
 
 LOGGER = logging.getLogger(__name__)
 
@@ -11,6 +15,9 @@ def retry(try_func, max_attempts, wait_sec,
           recover_func=None,
           num_attempts_before_recover=1,
           fail_fast_errors=None,
+          backoff=1,
+          max_wait_sec=None,
+          jitter=0.0,
           name=''):
     """
     Call `try_func` (lambda with no args) until it executes
@@ -29,6 +36,16 @@ def retry(try_func, max_attempts, wait_sec,
     `fail_fast_exceptions` is an optional list of exception types
     for which to fail immediately.
 
+    `backoff` is the factor by which the wait time grows after
+    each failed attempt; the wait before retrying attempt N is
+    `wait_sec * backoff ** N`.  The default keeps the wait fixed.
+
+    `max_wait_sec` is an optional upper bound on the wait time.
+
+    `jitter` randomly stretches each wait by up to that fraction,
+    so that several callers retrying at the same time
+    do not retry in lock-step.
+
     `name` is a unique name to use in log messages.
 
     Returns the output of the successful call to `try_func`.
@@ -61,9 +78,229 @@ def retry(try_func, max_attempts, wait_sec,
                 raise ex
 
             # Otherwise, wait a bit and retry
-            time.sleep(wait_sec)
+            time.sleep(_wait_time(num_attempts, wait_sec,
+                                  backoff, max_wait_sec, jitter))
 
             # Perform the recover function if one is provided
             if (recover_func is not None and num_attempts >= num_attempts_before_recover):
                 LOGGER.debug("{0}: Attempting recovery function.".format(name))
                 recover_func()
+
+
+def _wait_time(num_attempts, wait_sec, backoff, max_wait_sec, jitter):
+    """
+    Return the number of seconds to wait after `num_attempts`
+    failed attempts.  See `retry()` for the meaning of the other arguments.
+    """
+    delay = wait_sec * (backoff ** num_attempts) * (1 + random.random() * jitter)
+
+    if max_wait_sec is not None:
+        delay = min(delay, max_wait_sec)
+
+    return delay
+
+
+def map_in_threads(func, item_list, max_workers=None):
+    """
+    Call `func` on each item in `item_list` in separate threads,
+    and return the list of results in the same order as `item_list`.
+
+    Use this for independent calls that spend most of their time
+    waiting (e.g. on the file system or a subprocess).  Uses at most
+    `max_workers` threads (by default, one thread per item).
+    If there is only one item, `func` is called in the current thread.
+
+    Waits for every call to finish.  If any call raised an exception,
+    re-raises the one for the earliest item in `item_list`, so the
+    error does not depend on which thread happened to finish first.
+    """
+    result_list = [None] * len(item_list)
+    error_list = [None] * len(item_list)
+
+    def _call(index, item):
+        try:
+            result_list[index] = func(item)
+        except BaseException:
+            error_list[index] = sys.exc_info()
+
+    num_threads = len(item_list)
+    if max_workers is not None:
+        num_threads = min(num_threads, max_workers)
+
+    if num_threads > 1:
+
+        # Each thread takes the next item until there are none left
+        item_queue = Queue.Queue()
+        for index, item in enumerate(item_list):
+            item_queue.put((index, item))
+
+        def _call_queued():
+            while True:
+                try:
+                    index, item = item_queue.get_nowait()
+                except Queue.Empty:
+                    return
+                _call(index, item)
+
+        thread_list = [threading.Thread(target=_call_queued)
+                       for _ in range(num_threads)]
+        for thread in thread_list:
+            thread.start()
+        for thread in thread_list:
+            thread.join()
+
+    else:
+        for index, item in enumerate(item_list):
+            _call(index, item)
+
+    # If any call failed, raise the error here
+    for exc_info in error_list:
+        if exc_info is not None:
+            exc_type, exc_value, exc_traceback = exc_info
+            raise exc_type, exc_value, exc_traceback
+
+    return result_list
+
+
+class WorkerPoolStoppedError(Exception):
+    """
+    The worker pool stopped before running the task.
+    """
+    pass
+
+
+class WorkerPool(object):
+    """
+    Run tasks on a fixed number of background threads.
+    """
+
+    def __init__(self, num_threads):
+        """
+        Create a pool that runs tasks on `num_threads` threads.
+        No tasks run until the pool is started.
+        """
+        self._num_threads = num_threads
+        self._task_queue = Queue.Queue()
+        self._thread_list = []
+
+        # Once stopped, the pool does not run any more tasks.
+        # The lock ensures no task is queued after the
+        # threads have been told to exit.
+        self._is_stopped = False
+        self._stop_lock = threading.Lock()
+
+    def start(self):
+        """
+        Start the threads that run tasks.
+        """
+        for _ in range(self._num_threads):
+            thread = threading.Thread(target=self._run_tasks)
+            thread.daemon = True
+            thread.start()
+            self._thread_list.append(thread)
+
+    def stop(self):
+        """
+        Stop the pool, and wait for the tasks that are
+        already running to finish.  Tasks that have not
+        started yet raise a `WorkerPoolStoppedError`.
+
+        It is safe to call `stop()` more than once.
+        """
+        with self._stop_lock:
+            self._is_stopped = True
+
+            # Tell each thread to exit once it gets through the queue
+            for _ in self._thread_list:
+                self._task_queue.put(None)
+
+        for thread in self._thread_list:
+            thread.join()
+
+        self._thread_list = []
+
+    def submit(self, func, *args):
+        """
+        Queue a call to `func(*args)` and return a `WorkerPoolTask`
+        for its result.  If the pool has stopped, the task
+        raises a `WorkerPoolStoppedError`.
+        """
+        task = WorkerPoolTask(func, args)
+
+        with self._stop_lock:
+            if self._is_stopped:
+                task.cancel()
+            else:
+                self._task_queue.put(task)
+
+        return task
+
+    def _run_tasks(self):
+        """
+        Run queued tasks until we receive None.
+        """
+        while True:
+            task = self._task_queue.get()
+
+            if task is None:
+                return
+
+            # Don't start tasks queued before the pool stopped
+            elif self._is_stopped:
+                task.cancel()
+
+            else:
+                task.run()
+
+
+class WorkerPoolTask(object):
+    """
+    A call queued on a `WorkerPool`.
+    """
+
+    def __init__(self, func, args):
+        self._func = func
+        self._args = args
+        self._result = None
+        self._exc_info = None
+        self._is_done = threading.Event()
+
+    def run(self):
+        """
+        Call the function, storing its result or exception.
+        """
+        try:
+            self._result = self._func(*self._args)
+        except BaseException:
+            self._exc_info = sys.exc_info()
+        finally:
+            self._is_done.set()
+
+    def cancel(self):
+        """
+        Finish the task without calling the function.
+        """
+        try:
+            raise WorkerPoolStoppedError("Worker pool stopped before running the task.")
+        except WorkerPoolStoppedError:
+            self._exc_info = sys.exc_info()
+        finally:
+            self._is_done.set()
+
+    def wait(self, timeout=None):
+        """
+        Wait until the task finishes, or for at most `timeout` seconds.
+        Returns True if the task finished.
+        """
+        return self._is_done.wait(timeout)
+
+    def result(self):
+        """
+        Return the result of the finished task.  If the function
+        raised an exception, re-raise it here.
+        """
+        if self._exc_info is not None:
+            exc_type, exc_value, exc_traceback = self._exc_info
+            raise exc_type, exc_value, exc_traceback
+
+        return self._result